@@ -0,0 +1,98 @@
+import math
+import time
+import faiss
+import numpy as np
+
+# "flat" is exact search, the others are approximate:
+#   ivf     inverted lists over k-means cells, full vectors
+#   hnsw    graph search, full vectors, no training
+#   ivfpq   inverted lists with product-quantized vectors (1/64 of the memory at 768 dimensions)
+#   ivfsq8  inverted lists with 8-bit scalar-quantized vectors (1/4 of the memory)
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq", "ivfsq8")
+
+# Search-time knobs: cells visited per query for IVF, candidate list size for HNSW
+NPROBE = 8
+EF_SEARCH = 64
+
+HNSW_M = 32
+
+# PQ sub-vectors per vector, lowered to a divisor of the dimension if needed.
+# Each residual is coded in 4 bits with SIMD fast-scan tables: 8-bit codebooks take
+# minutes to train on a single core, 4-bit ones seconds.
+PQ_SUBVECTORS = 96
+
+# 4-bit PQ codebooks have 16 centroids per sub-vector and want about 39 vectors each
+PQ_MIN_TRAIN = 39 * 16
+
+# Vectors sampled for training, k-means gains little past this
+TRAIN_SAMPLE = 100000
+
+
+def nlist_for(count):
+    """ Number of IVF cells: about 4 * sqrt(n), with at least 39 training vectors per cell """
+    return max(1, min(int(4 * math.sqrt(count)), count // 39))
+
+
+def pq_subvectors_for(dim):
+    return max(m for m in range(2, min(PQ_SUBVECTORS, dim) + 1, 2) if dim % m == 0)
+
+
+def factory_string(index_type, count, dim):
+    """ faiss.index_factory description of index_type for count vectors
+
+    Returns "Flat" when there are too few vectors to train the index, and
+    falls back from PQ to SQ8 codes below PQ_MIN_TRAIN vectors.
+    """
+    nlist = nlist_for(count)
+    if index_type == "flat" or (index_type.startswith("ivf") and nlist < 2):
+        return "Flat"
+    if index_type == "ivf":
+        return f"IVF{nlist},Flat"
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M}"
+    if index_type == "ivfpq":
+        return f"IVF{nlist},PQ{pq_subvectors_for(dim)}x4fsr" if count >= PQ_MIN_TRAIN else f"IVF{nlist},SQ8"
+    if index_type == "ivfsq8":
+        return f"IVF{nlist},SQ8"
+    raise ValueError(f"Unknown index type {index_type!r}, expected one of {', '.join(INDEX_TYPES)}")
+
+
+def build_index(vectors, index_type="flat"):
+    """ Train and fill a CPU index of index_type, rows keep the order of vectors
+
+    Returns the index and the seconds spent training.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    count, dim = vectors.shape
+    index = faiss.index_factory(dim, factory_string(index_type, count, dim))
+
+    start = time.perf_counter()
+    if not index.is_trained:
+        sample = vectors
+        if count > TRAIN_SAMPLE:
+            sample = vectors[np.random.default_rng(0).choice(count, TRAIN_SAMPLE, replace=False)]
+        index.train(sample)
+    train_seconds = time.perf_counter() - start
+
+    index.add(vectors)
+    return index, train_seconds
+
+
+def set_search_params(index, nprobe=NPROBE, ef_search=EF_SEARCH):
+    """ Apply nprobe to IVF indexes and efSearch to HNSW ones, other indexes are left alone """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = ef_search
+    return index
+
+
+def all_vectors(index):
+    """ Every stored vector of an exact index, in row order """
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def index_bytes(index):
+    return faiss.serialize_index(index).nbytes
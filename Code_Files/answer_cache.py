@@ -0,0 +1,128 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import time
+
+CACHE_PATH = ".answer_cache.sqlite"
+
+# Answers older than a week or beyond the newest 5000 are evicted
+MAX_AGE = 7 * 24 * 60 * 60
+MAX_ENTRIES = 5000
+
+
+def make_key(document_hashes, model_config, question, history=None):
+    """ Cache key from the documents, the model setup, the question and any chat history """
+    payload = json.dumps({
+        "documents": sorted(document_hashes),
+        "model": model_config,
+        "question": question,
+        "history": history or [],
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """ Persistent SQLite store of model answers """
+
+    def __init__(self, path=CACHE_PATH, max_age=MAX_AGE, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        # A connection per call keeps the cache usable from the question worker threads
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT response FROM answers WHERE key = ? AND created_at > ?",
+                (key, now - self.max_age)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO answers (key, response, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+
+    def evict(self):
+        """ Drop answers past max_age, then the least recently used beyond max_entries """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM answers WHERE created_at <= ?", (time.time() - self.max_age,))
+            conn.execute(
+                "DELETE FROM answers WHERE key NOT IN "
+                "(SELECT key FROM answers ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+
+
+def cached_ask(ask, cache, document_hashes, model_config, refresh=False):
+    """ Wrap an ask(question, history) function so answers are looked up before calling the model
+
+    With refresh=True cached answers are ignored but fresh ones are still stored.
+    The wrapper's lookup(question, history) and store(question, response_text,
+    history) use the same keys, for answers that arrive some other way such
+    as in a batch.
+    """
+    def lookup(question, history=None):
+        """ The cached (response_text, stats), or None """
+        if refresh:
+            return None
+        response_text = cache.get(make_key(document_hashes, model_config, question, history))
+        if response_text is None:
+            return None
+        return response_text, {"latency": 0.0, "prompt_tokens": 0, "output_tokens": 0, "cached": True}
+
+    def store(question, response_text, history=None):
+        cache.put(make_key(document_hashes, model_config, question, history), response_text)
+
+    def ask_with_cache(question, history=None):
+        cached = lookup(question, history)
+        if cached is not None:
+            return cached
+
+        response_text, stats = ask(question, history)
+        store(question, response_text, history)
+        return response_text, stats
+
+    ask_with_cache.lookup = lookup
+    ask_with_cache.store = store
+    return ask_with_cache
+
+
+def cache_options(argv=None):
+    """ Read --no-cache and --refresh-cache from the command line
+
+    Under Streamlit pass them after a double dash: streamlit run app.py -- --no-cache
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--no-cache", action="store_true", help="Neither read nor store cached answers")
+    parser.add_argument("--refresh-cache", action="store_true", help="Ask the model again and overwrite cached answers")
+    options, _ = parser.parse_known_args(argv)
+    return options
+
+
+def with_answer_cache(ask, document_hashes, model_config, argv=None):
+    """ Put the answer cache in front of ask() unless --no-cache was given """
+    options = cache_options(argv)
+    if options.no_cache:
+        return ask
+
+    cache = AnswerCache()
+    cache.evict()
+    return cached_ask(ask, cache, document_hashes, model_config, refresh=options.refresh_cache)
@@ -1,66 +1,248 @@
 import streamlit as st
 import os
-import time
-import google.generativeai as genai
 from dotenv import load_dotenv
-import re
-from docx import Document as WordDoc
-from docx.oxml import OxmlElement
-from docx2pdf import convert
+from functools import partial
 import base64
+import time
+import uuid
+from argparse import Namespace
+from answer_cache import cache_options, with_answer_cache
+from doc_prep import docx2pdf_converter, prepare_documents, print_stage_report
+from job_queue import JobQueue, upload_key
+from markdown_parser import parse_blocks
+from model_client import get_client
+from question_executor import (ask_question, ask_with_context, iter_questions, run_questions_batched, extraction_options,
+                               print_usage_report, compare_modes, mode_comparison, print_mode_comparison)
+from rate_limit import RateLimitedModel, throttled
+from template_filler import TemplateFiller
+from upload_cache import UploadCache, file_hash
+from vector_search import update_vector_store, retrieve_passages
 
 # Load environment variables
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY_2")
 
-# Configure Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
+# Gemini API client, or an offline fake with MODEL_CLIENT=fake
+client = get_client(GEMINI_API_KEY)
+
+# File API calls from every job share one limiter, set with FILES_RPM
+get_file = throttled(client.get_file, "files")
+
+# Paths. Each job writes its uploads, RFP index and proposal in its own
+# working directory, so concurrent proposals never touch each other's files.
+template_path = "../Proposal_Documents/Emerson_Proposal_Template.docx"
+OUTPUT_NAME = "filled_template.docx"
+RAG_INDEX_NAME = "rfp_index"
+
+# Seconds between status checks while a job runs
+POLL_INTERVAL = 1.0
+
+# Configure Gemini model
+generation_config = {
+    "temperature": 0.1,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+    "response_mime_type": "text/plain",
+}
+
+model_name = "gemini-2.0-flash"
+system_instruction = """
+    You are an expert file search assistant. Provide concise and structured responses based solely on the provided content and the query's requirements. 
+    Do not ignore related content to the query as the information is very critical. If asked to list out details about anything make sure to include all the data related to it.
+    Avoid including example information, formulas, or unnecessary details in your answers. Make sure to include tabular information wherever detected.
+    """
+
+# The model setup, part of every answer's cache key and of every job's key
+model_config = {
+    "client": client.kind,
+    "model_name": model_name,
+    "system_instruction": system_instruction,
+    "generation_config": generation_config,
+}
+
+# Questions with tags, each answered in its own request.
+# Add "dependent": True to a question that needs the earlier answers as context.
+questions_with_tags = [
+    {"question": "List out all the application software modules to be provided.", "tag": "<<Modules>>"},
+    {"question": "List out all details of all the pipelines required to be configured in a table.", "tag": "<<Scope of Assets>>"},
+    {"question": "List out all the deliverables from the APPS Vendor side.", "tag": "<<Deliverables>>"},
+    {"question": "What are all the works to be performed for the customer assets?", "tag": "<<Work to be performed>>"},
+    {"question": "What all hardware requirements are mentioned?", "tag": "<<Hardware requirement>>"},
+    {"question": "What are the products to be covered in terms of crude, HSD, MS or so?", "tag":"<<Product Type>>"},
+    {"question": "Respond only with 'Leak Sensitivity Study' if Leak sensitivity study is required or else respond with an empty space.", "tag": "<<Leak Sensitivity Study>>"},
+    {"question": "Just give how many training days are required.","tag": "<<Training Days>>"},
+    {"question": "Respond only with 'Dual Redundant' if Dual redundant PipelineManager is required or else respond with an empty space.", "tag": "<<Dual Redundant>>"},
+    # {"question": "Just give the customer name which you can find in the header.", "tag": "<<Customer Name>>"},
+    # {"question": "Just give the project name which can be found in the header.", "tag": "<<Project Name>>"},
+    # {"question": "Just give the Tender No. from the footer", "tag":"<<Customer Ref Number>>"}
+]
+
 
 # Upload file to Gemini
 def upload_to_gemini(path, mime_type="application/pdf"):
     try:
-        file = genai.upload_file(path, mime_type=mime_type)
+        file = throttled(client.upload, "files")(path, mime_type=mime_type)
         return file
     except Exception as e:
-        st.error(f"Error uploading file: {e}")
+        # Runs on a preparation worker, failures are shown once all files are done
+        print(f"Error uploading file {path}: {e}")
         return None
 
-# Wait for file processing
-def wait_for_files_active(files):
-    print("Waiting for file processing...")
-    for name in (file.name for file in files):
-        file = genai.get_file(name)
-        while file.state.name == "PROCESSING":
-            print(".", end="", flush=True)
-            time.sleep(10)
-            file = genai.get_file(name)
-        if file.state.name != "ACTIVE":
-            raise Exception(f"File {file.name} failed to process")
-    print("...all files ready\n")
-
-def convert_docx_to_pdf(docx_path):
-    """ Convert .docx to .pdf using docx2pdf """
-    pdf_path = docx_path.replace(".docx", ".pdf")
-    convert(docx_path, pdf_path)
-    return pdf_path
-
-def save_uploaded_files(uploaded_files):
-    """ Save uploaded file and convert .docx to .pdf if needed """
-    file_paths = []
-    os.makedirs("Uploaded_Docs", exist_ok=True)
-
-    for uploaded_file in uploaded_files:
-        temp_path = os.path.join("Uploaded_Docs", uploaded_file.name)
-        with open(temp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-
-        if uploaded_file.name.endswith(".docx"):
-            pdf_path = convert_docx_to_pdf(temp_path)
-            file_paths.append(pdf_path)
-        else:
-            file_paths.append(temp_path)
-
-    return file_paths
+@st.cache_resource
+def shared_upload_cache():
+    """ One upload cache for every job, so concurrent jobs don't overwrite each other's entries """
+    upload_cache = UploadCache(upload_to_gemini, get_file)
+    upload_cache.evict_expired()
+    return upload_cache
+
+def run_extraction(job):
+    """ The whole upload -> questions -> fill -> convert pipeline, run by a queue worker """
+    options = Namespace(**job.options)
+
+    # Files are written, converted, uploaded and processed side by side, and
+    # files with the same content as an earlier run are not uploaded again.
+    # RAG alone only reads the saved files, so nothing is converted or uploaded.
+    upload = not options.rag or options.compare
+    job.update(stage="Uploading and processing documents" if upload else "Saving documents")
+    start = time.perf_counter()
+    prepared = prepare_documents(job.input_files(), shared_upload_cache() if upload else None, get_file,
+                                 upload_dir=os.path.join(job.workdir, "Uploaded_Docs"), upload=upload)
+    print_stage_report(prepared, time.perf_counter() - start)
+
+    processed_files = [record["path"] for record in prepared]
+    source_files = [record["source"] for record in prepared]
+    gemini_files = [record["remote"] for record in prepared if record["remote"] is not None]
+    if upload:
+        job.update(failed_uploads=[record["name"] for record in prepared if record["remote"] is None])
+        if not gemini_files:
+            raise Exception("None of the files could be uploaded")
+
+    # Every job's requests go through the process-wide limiter, set with MODEL_RPM and MODEL_TPM,
+    # which also adapts how many run at once and retries throttled ones
+    model = RateLimitedModel(client.model(
+        model_name=model_name,
+        generation_config=generation_config,
+        system_instruction=system_instruction
+    ))
+
+    # Run with --rag to send each question with only its top-k chunks of the RFP
+    # instead of the whole documents, and --compare to report both modes per tag
+    full_ask = partial(ask_question, model, gemini_files)
+    rag_ask = None
+    if options.rag or options.compare:
+        job.update(stage="Indexing the RFP")
+        index_path = os.path.join(job.workdir, RAG_INDEX_NAME)
+        changes = update_vector_store(source_files, index_path=index_path)
+        print(f"RFP index: {changes['added']} chunks added, {changes['removed']} removed, {changes['kept']} unchanged")
+        retrieve = partial(retrieve_passages, k=options.top_k, index_path=index_path)
+        rag_ask = partial(ask_with_context, model, retrieve)
+
+    # Answers are cached per document content, question and model setup,
+    # run with --no-cache or --refresh-cache to bypass the cache. RAG answers
+    # come from the saved files, which are there whether or not they were uploaded.
+    answer_config = dict(model_config)
+    if options.rag:
+        answer_config["retrieval"] = {"top_k": options.top_k}
+    document_files = source_files if options.rag else processed_files
+    ask = with_answer_cache(rag_ask if options.rag else full_ask, [file_hash(path) for path in document_files], answer_config)
+
+    # Answers are published and filled into the template as soon as each one arrives
+    job.update(stage="Answering questions")
+    filler = TemplateFiller(template_path)
+    if options.batch and not options.rag:
+        answers = enumerate(run_questions_batched(model, gemini_files, ask, questions_with_tags))
+    else:
+        answers = iter_questions(ask, questions_with_tags)
+
+    all_responses = [None] * len(questions_with_tags)
+    for i, item in answers:
+        all_responses[i] = item
+        filler.fill(item)
+        job.update(responses=list(all_responses))
+    print_usage_report(all_responses)
+
+    if options.compare:
+        # Both modes are asked afresh so the tokens and latencies are comparable
+        job.update(stage="Comparing full documents and RAG")
+        rows = mode_comparison(*compare_modes(full_ask, rag_ask, questions_with_tags))
+        print_mode_comparison(rows)
+        job.update(comparison=rows)
+
+    # Process Template
+    job.update(stage="Filling the template")
+    output_path = os.path.join(job.workdir, OUTPUT_NAME)
+    filler.save(output_path)
+
+    # Convert .docx to PDF
+    job.update(stage="Converting the proposal to PDF")
+    output_pdf_path = output_path.replace(".docx", ".pdf")
+    # On a queue worker thread, so through the converter that sets up COM and takes Word's lock
+    docx2pdf_converter(output_path, output_pdf_path)
+    job.update(stage="Done", proposal_path=output_path, pdf_path=output_pdf_path)
+
+def show_response(item):
+    """ Render one answer """
+    st.subheader(item["tag"].strip("<>"))
+    for block in parse_blocks(item["response"]):
+        st.markdown(block["text"])
+
+@st.cache_data(max_entries=8)
+def read_output(path):
+    """ Finished proposal files never change, reruns read them from memory """
+    with open(path, "rb") as f:
+        return f.read()
+
+def show_job(state):
+    """ Render whatever the job has produced so far """
+    for name in state.get("failed_uploads", []):
+        st.error(f"Error uploading file: {name}")
+
+    if state["status"] == "failed":
+        st.error(f"Processing failed: {state['error']}")
+    elif state["status"] == "queued":
+        st.info(f"Queued, {state['ahead']} proposals ahead")
+    elif state["status"] == "running":
+        st.info(f"{state['stage']}... ({state['elapsed']:.0f}s)")
+
+    for item in state.get("responses", []):
+        if item is not None:
+            show_response(item)
+
+    if state.get("comparison"):
+        st.subheader("Full documents vs RAG")
+        st.table(state["comparison"])
+
+    if state["status"] != "done":
+        return
+
+    st.success(f"Template filled successfully in {state['elapsed']:.0f}s!")
+
+    # Display download button for PDF
+    st.download_button(
+        label="Download Proposal Document",
+        data=read_output(state["proposal_path"]),
+        file_name="Processed_RFP_Template.docx",
+        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    )
+
+    # Display PDF in Streamlit
+    base64_pdf = base64.b64encode(read_output(state["pdf_path"])).decode('utf-8')
+    pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="700" height="800" type="application/pdf"></iframe>'
+    st.markdown(pdf_display, unsafe_allow_html=True)
+
+@st.cache_resource
+def job_queue():
+    """ The queue and its worker pool, shared by every session in the process """
+    return JobQueue({"proposal": run_extraction}).start()
+
+@st.fragment(run_every=POLL_INTERVAL)
+def poll_job(job_id):
+    """ Re-render only this part of the page while the job waits or runs, then the whole page once """
+    state = job_queue().snapshot(job_id)
+    if state["status"] in ("done", "failed"):
+        st.rerun()
+    show_job(state)
 
 # Streamlit UI
 st.title("AI RFP Processing with Gemini")
@@ -71,229 +253,26 @@ uploaded_files = st.file_uploader("Upload your RFP documents (Supports multiple
 if uploaded_files:
     st.success(f"{len(uploaded_files)} files uploaded successfully!!")
 
-    processed_files = save_uploaded_files(uploaded_files)
-
-    gemini_files = []
-    for file_path in  processed_files:
-        gemini_file = upload_to_gemini(file_path)
-        if gemini_file:
-            gemini_files.append(gemini_file)
-
-    if gemini_files:
-        st.success("Files uploaded and processing started...")
-        wait_for_files_active(gemini_files)
-
-        # Configure Gemini model
-        generation_config = {
-            "temperature": 0.1,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 8192,
-            "response_mime_type": "text/plain",
-        }
-
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash",
-            generation_config=generation_config,
-            system_instruction="""
-            You are an expert file search assistant. Provide concise and structured responses based solely on the provided content and the query's requirements. 
-            Do not ignore related content to the query as the information is very critical. If asked to list out details about anything make sure to include all the data related to it.
-            Avoid including example information, formulas, or unnecessary details in your answers. Make sure to include tabular information wherever detected.
-            """
-        )
-
-        chat_session = model.start_chat(history=[])
-
-        # Questions with tags
-        questions_with_tags = [
-            {"question": "List out all the application software modules to be provided.", "tag": "<<Modules>>"},
-            {"question": "List out all details of all the pipelines required to be configured in a table.", "tag": "<<Scope of Assets>>"},
-            {"question": "List out all the deliverables from the APPS Vendor side.", "tag": "<<Deliverables>>"},
-            {"question": "What are all the works to be performed for the customer assets?", "tag": "<<Work to be performed>>"},
-            {"question": "What all hardware requirements are mentioned?", "tag": "<<Hardware requirement>>"},
-            {"question": "What are the products to be covered in terms of crude, HSD, MS or so?", "tag":"<<Product Type>>"},
-            {"question": "Respond only with 'Leak Sensitivity Study' if Leak sensitivity study is required or else respond with an empty space.", "tag": "<<Leak Sensitivity Study>>"},
-            {"question": "Just give how many training days are required.","tag": "<<Training Days>>"},
-            {"question": "Respond only with 'Dual Redundant' if Dual redundant PipelineManager is required or else respond with an empty space.", "tag": "<<Dual Redundant>>"},
-            # {"question": "Just give the customer name which you can find in the header.", "tag": "<<Customer Name>>"},
-            # {"question": "Just give the project name which can be found in the header.", "tag": "<<Project Name>>"},
-            # {"question": "Just give the Tender No. from the footer", "tag":"<<Customer Ref Number>>"}
-        ]
-
-        # Process questions
-        all_responses = [] # Response for each question
-
-        for i, item in enumerate(questions_with_tags):
-            question, tag = item["question"], item["tag"]
-            print(f"Sending question {i + 1}/{len(questions_with_tags)}: {question}")
-
-            response = chat_session.send_message([*gemini_files, question])
-            response_text = response.text.strip()
-
-            all_responses.append({"question": question, "tag": tag, "response": response_text})
-
-            print("Response: ", response_text)
-
-
-        # Extract tables and surrounding text
-        def extract_tables_and_text(text):
-            sections = re.split(r'<br\s*/?>', text)
-            extracted_tables, before_table, after_table = [], "", ""
-            table_found = False
-
-            for section in sections:
-                lines = section.strip().split("\n")
-                table_lines, inside_table = [], False
-
-                for line in lines:
-                    if "|" in line:
-                        table_lines.append(line)
-                        inside_table = True
-                    elif inside_table and line.strip():
-                        table_lines.append(line)
-                    elif inside_table and not line.strip():
-                        inside_table = False
-                    elif not table_found:
-                        before_table += line + "\n"
-                    else:
-                        after_table += line + "\n"
-
-                if table_lines:
-                    extracted_tables.append("\n".join(table_lines).strip())
-                    table_found = True
-
-            return before_table.strip(), extracted_tables, after_table.strip()
-
-
-        # Insert an element after a paragraph (helper function)
-        def insert_element_after(paragraph, element):
-            p = paragraph._p
-            p.addnext(element)
-
-
-        # Add table after a paragraph
-        def add_table_after_paragraph(paragraph, table_text):
-            lines = table_text.strip().split("\n")
-            if len(lines) < 2:
-                return
-
-            headers = [h.strip() for h in lines[0].split("|")[1:-1]]
-            rows = [
-                [col.strip() for col in line.split("|")[1:-1]]
-                for line in lines[2:]
-                if len(line.split("|")) - 2 == len(headers)
-            ]
-
-            if not rows:
-                return
-
-            # Create a temporary document to build the table
-            temp_doc = WordDoc()
-            table = temp_doc.add_table(rows=len(rows) + 1, cols=len(headers))
-            table.style = 'Table Grid'
-
-            # Fill headers
-            for i, header in enumerate(headers):
-                table.cell(0, i).text = header
-
-            # Fill rows
-            for row_idx, row in enumerate(rows):
-                for col_idx, cell_text in enumerate(row):
-                    table.cell(row_idx + 1, col_idx).text = cell_text
-
-            # Insert the table after the target paragraph
-            insert_element_after(paragraph, table._element)
-
-
-        # Add a new paragraph after a paragraph
-        def add_paragraph_after(paragraph, text):
-            new_paragraph = OxmlElement('w:p')
-            insert_element_after(paragraph, new_paragraph)
-            p = paragraph._parent.add_paragraph(text)
-            insert_element_after(paragraph, p._element)
-            return p
-
-
-        # Fill template with responses
-        def fill_template(template_path, output_path, response_data):
-            doc = WordDoc(template_path)
-
-            for item in response_data:
-                tag, response = item["tag"], item["response"].strip()
-                before_text, tables, after_text = extract_tables_and_text(response)
-
-                for para in doc.paragraphs:
-                    if tag in para.text:
-                        # Remove the tag from the paragraph
-                        para.text = para.text.replace(tag, "")
-
-                        # Add before_text to the same paragraph
-                        if before_text:
-                            para.add_run(before_text.strip())
-
-                        # Add tables after the paragraph
-                        for table_text in tables:
-                            add_table_after_paragraph(para, table_text)
-
-                        # Add after_text as a new paragraph
-                        if after_text:
-                            add_paragraph_after(para, after_text.strip())
-
-                # Replace in tables
-                for table in doc.tables:
-                    for row in table.rows:
-                        for cell in row.cells:
-                            if tag in cell.text:
-                                cell.text = cell.text.replace(tag, response)
-
-                # # Replace in headers
-                # for section in doc.sections:
-                #     header = section.header
-                #     for para in header.paragraphs:
-                #         for run in para.runs:  # Modify runs instead of full text replacement
-                #             if tag in run.text:
-                #                 run.text = run.text.replace(tag, response)
-
-                # for section in doc.sections:
-                #     header = section.header
-                #     for para in header.paragraphs:
-                #         full_text = "".join(run.text for run in para.runs)  # Get full text from runs
-                #         if tag in full_text:
-                #             new_text = full_text.replace(tag, response)
-                #             para.clear()  # Remove existing content
-                #             para.add_run(new_text)  # Add modified text
-
-                # # Replace Rich Text Content Control placeholders
-                # for sdt in doc.element.xpath('//w:sdt/w:sdtContent//w:t'):
-                #     if tag in sdt.text:
-                #         sdt.text = sdt.text.replace(tag, response)
-
-            doc.save(output_path)
-            print(f"Template filled and saved to {output_path}")
-
-        # Paths
-        template_path = "../Proposal_Documents/Emerson_Proposal_Template.docx"
-        output_path = "../Proposal_Documents/streamlit_filled_template_16.docx"
-
-        # Process Template
-        fill_template(template_path, output_path, all_responses)
-        st.success("Template filled successfully!")
-
-        # Convert .docx to PDF
-        output_pdf_path = output_path.replace(".docx", ".pdf")
-        convert(output_path, output_pdf_path)
-
-        # Display download button for PDF
-        with open(output_path, "rb") as file:
-            btn = st.download_button(
-                label="Download Proposal Document",
-                data=file,
-                file_name="Processed_RFP_Template.docx",
-                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-            )
-
-        # Display PDF in Streamlit
-        with open(output_pdf_path, "rb") as pdf_file:
-            base64_pdf = base64.b64encode(pdf_file.read()).decode('utf-8')
-            pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="700" height="800" type="application/pdf"></iframe>'
-            st.markdown(pdf_display, unsafe_allow_html=True)
+    # One job per set of uploaded documents, options, template, questions and model setup,
+    # queued with the other users' jobs and shared with them only when all of those match.
+    # Reruns, such as a click on the download button, find the job and only render it.
+    options = extraction_options()
+    cache_flags = cache_options()
+    key = upload_key(uploaded_files, vars(options), file_hash(template_path), questions_with_tags, model_config,
+                     vars(cache_flags))
+    owner = st.session_state.setdefault("owner", uuid.uuid4().hex)
+    jobs = st.session_state.setdefault("jobs", {})
+
+    # A finished proposal is reused unless it is regenerated or the answer cache is being refreshed
+    state = job_queue().snapshot(jobs[key]) if key in jobs else None
+    regenerate = state is not None and state["status"] == "done" and st.button("Regenerate")
+    if state is None or regenerate or state["status"] == "failed" and st.button("Retry"):
+        jobs[key] = job_queue().submit(owner, key, "proposal",
+                                       [(f.name, f.getvalue()) for f in uploaded_files], vars(options),
+                                       reuse_done=not (regenerate or cache_flags.refresh_cache))
+        state = job_queue().snapshot(jobs[key])
+
+    if state["status"] in ("done", "failed"):
+        show_job(state)
+    else:
+        poll_job(jobs[key])
@@ -0,0 +1,72 @@
+import sys
+import time
+import numpy as np
+from ann_index import INDEX_TYPES, factory_string, build_index, set_search_params, index_bytes
+
+# Corpus sizes to compare, pass others on the command line: python bench_ann.py 20000 200000
+VECTOR_COUNTS = [10000, 50000]
+DIM = 768
+QUERIES = 200
+K = 10
+
+# Search-time settings swept for each index type
+NPROBES = [1, 4, 16, 64]
+EF_SEARCHES = [16, 64, 256]
+
+
+def synthetic_corpus(count, dim=DIM, topics=200, seed=0):
+    """ Unit vectors around a few hundred topics, closer to chunk embeddings than uniform noise """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((topics, dim)).astype(np.float32)
+    vectors = centres[rng.integers(topics, size=count)] + 0.6 * rng.standard_normal((count, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    # Queries are perturbed corpus vectors, like questions phrased close to a chunk
+    queries = vectors[rng.choice(count, QUERIES, replace=False)] + 0.05 * rng.standard_normal((QUERIES, dim)).astype(np.float32)
+    return vectors, queries.astype(np.float32)
+
+
+def search_time(index, queries):
+    """ Mean milliseconds per query, queries sent one at a time as the app does """
+    start = time.perf_counter()
+    results = [index.search(query[None, :], K)[1][0] for query in queries]
+    return (time.perf_counter() - start) * 1000 / len(queries), np.array(results)
+
+
+def recall(results, truth):
+    """ Share of the exact top K found by the index """
+    return np.mean([len(set(found) & set(expected)) / K for found, expected in zip(results, truth)])
+
+
+def settings_for(index_type):
+    """ (label, set_search_params keyword arguments) to sweep for index_type """
+    if index_type == "hnsw":
+        return [(f"efSearch={ef}", {"ef_search": ef}) for ef in EF_SEARCHES]
+    if index_type.startswith("ivf"):
+        return [(f"nprobe={nprobe}", {"nprobe": nprobe}) for nprobe in NPROBES]
+    return [("exact", {})]
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or VECTOR_COUNTS
+
+    for count in counts:
+        vectors, queries = synthetic_corpus(count)
+        print(f"\n{count} vectors of {DIM} dimensions, {QUERIES} queries, recall@{K} against flat")
+        print(f"{'Index':<22} {'Setting':>14} {'Build (s)':>10} {'Train (s)':>10} {'MB':>8} "
+              f"{'ms/query':>9} {'Recall':>7}")
+
+        truth = None
+        for index_type in INDEX_TYPES:
+            start = time.perf_counter()
+            index, train_seconds = build_index(vectors, index_type)
+            build_seconds = time.perf_counter() - start
+            megabytes = index_bytes(index) / 1024 / 1024
+
+            for setting, params in settings_for(index_type):
+                set_search_params(index, **params)
+                ms, results = search_time(index, queries)
+                if truth is None:
+                    truth = results
+                print(f"{factory_string(index_type, count, DIM):<22} {setting:>14} {build_seconds:>10.2f} "
+                      f"{train_seconds:>10.2f} {megabytes:>8.1f} {ms:>9.3f} {recall(results, truth):>7.3f}")
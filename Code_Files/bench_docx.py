@@ -0,0 +1,90 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from docx import Document as WordDoc
+from doc_prep import libreoffice_converter
+from docx_extract import iter_docx_blocks
+from pdf_extract import iter_pdf_pages
+from template_filler import build_table_element
+
+# Sections in the synthetic RFP, pass others on the command line: python bench_docx.py 100 2000
+SECTION_COUNTS = [100, 1000, 5000]
+PARAGRAPHS_PER_SECTION = 8
+TABLE_ROWS = 10
+
+
+def synthetic_docx(path, sections, label=""):
+    """ Headings, prose and a pipeline table per section, the shape of a tender document
+
+    label goes into every heading, so documents of different runs share no text.
+    """
+    doc = WordDoc()
+    doc.sections[0].header.paragraphs[0].text = "Tender No. GAIL/05/PL/2024"
+    for s in range(sections):
+        doc.add_heading(f"{label}Section {s}: Leak detection scope", level=2)
+        for p in range(PARAGRAPHS_PER_SECTION):
+            doc.add_paragraph(f"Clause {s}.{p}: the vendor shall configure PipelineManager for every listed pipeline "
+                              f"and provide training, hardware and a leak sensitivity study where required.")
+        rows = [[f"Pipeline {s}-{r}", str(r * 7), "HSD", f"Tap-off at km {r}"] for r in range(TABLE_ROWS)]
+        doc.element.body._insert_tbl(build_table_element(["Pipeline", "Length (km)", "Product", "Notes"], rows))
+    doc.save(path)
+
+
+def python_docx_blocks(path):
+    """ Loading the whole document with python-docx, the non-streaming way to read it """
+    doc = WordDoc(path)
+    texts = [paragraph.text for paragraph in doc.paragraphs]
+    tables = [[[cell.text for cell in row.cells] for row in table.rows] for table in doc.tables]
+    return texts, tables
+
+
+def converted_pages(path):
+    """ The conversion path: render a PDF with LibreOffice, then extract its text """
+    pdf_path = path[:-len(".docx")] + ".pdf"
+    libreoffice_converter(path, pdf_path)
+    return list(iter_pdf_pages([pdf_path]))
+
+
+def measured(read, path):
+    """ (seconds, peak MB of Python allocations) of one read
+
+    The peak comes from a second, traced run, tracing slows the read down.
+    """
+    start = time.perf_counter()
+    read(path)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    read(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024
+
+
+def timed(read, path):
+    start = time.perf_counter()
+    read(path)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    section_counts = [int(arg) for arg in sys.argv[1:]] or SECTION_COUNTS
+    can_convert = bool(shutil.which("soffice") or shutil.which("libreoffice"))
+    if not can_convert:
+        print("LibreOffice not found, the conversion path is skipped")
+
+    print(f"{'Sections':>9} {'Size (MB)':>10} {'native (s)':>11} {'peak MB':>8} "
+          f"{'python-docx (s)':>16} {'peak MB':>8} {'convert+extract (s)':>20}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for sections in section_counts:
+            path = os.path.join(tmp_dir, f"rfp_{sections}.docx")
+            synthetic_docx(path, sections)
+
+            native, native_peak = measured(lambda p: sum(1 for _ in iter_docx_blocks(p)), path)
+            loaded, loaded_peak = measured(python_docx_blocks, path)
+            converted = f"{timed(converted_pages, path):>20.2f}" if can_convert else f"{'-':>20}"
+            print(f"{sections:>9} {os.path.getsize(path) / 1024 / 1024:>10.1f} {native:>11.2f} {native_peak:>8.1f} "
+                  f"{loaded:>16.2f} {loaded_peak:>8.1f} {converted}")
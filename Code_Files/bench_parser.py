@@ -0,0 +1,93 @@
+import re
+import sys
+import time
+from markdown_parser import parse_blocks
+
+# Approximate response sizes in megabytes, pass others on the command line: python bench_parser.py 1 8
+SIZES_MB = [1, 4, 16]
+
+
+def extract_tables_and_text(text):
+    """ The previous parser, kept here as the baseline """
+    sections = re.split(r'<br\s*/?>', text)
+    extracted_tables, before_table, after_table = [], "", ""
+    table_found = False
+
+    for section in sections:
+        lines = section.strip().split("\n")
+        table_lines, inside_table = [], False
+
+        for line in lines:
+            if "|" in line:
+                table_lines.append(line)
+                inside_table = True
+            elif inside_table and line.strip():
+                table_lines.append(line)
+            elif inside_table and not line.strip():
+                inside_table = False
+            elif not table_found:
+                before_table += line + "\n"
+            else:
+                after_table += line + "\n"
+
+        if table_lines:
+            extracted_tables.append("\n".join(table_lines).strip())
+            table_found = True
+
+    return before_table.strip(), extracted_tables, after_table.strip()
+
+
+def old_parse(text):
+    """ Previous parser plus the row splitting add_table_after_paragraph did on each table """
+    before_text, tables, after_text = extract_tables_and_text(text)
+    for table_text in tables:
+        lines = table_text.strip().split("\n")
+        headers = [h.strip() for h in lines[0].split("|")[1:-1]]
+        [
+            [col.strip() for col in line.split("|")[1:-1]]
+            for line in lines[2:]
+            if len(line.split("|")) - 2 == len(headers)
+        ]
+    return before_text, tables, after_text
+
+
+def synthetic_response(size_mb):
+    """ Alternating prose and pipeline tables, the shape of a long Gemini answer """
+    section = (
+        "The pipelines listed below are in the scope of the leak detection system.\n"
+        "Each one needs a model configured in PipelineManager.\n\n"
+        "| Pipeline | Length (km) | Product | Notes |\n"
+        "|:---|---:|:---:|---|\n"
+        + "".join(f"| Section {r} | {r * 3} | HSD | Tap-off at km {r} \\| metering |\n" for r in range(40))
+        + "<br>\n"
+        # Inline <br> around and after a table, the text either side is its own section
+        + "Summary<br>Totals below<br>| Product | Pipelines |\n|---|---|\n| HSD | 40 |<br>End of scope\n"
+    )
+    return section * max(1, int(size_mb * 1024 * 1024 / len(section)))
+
+
+# Inline <br> splits the text from the table rows it shares a line with
+INLINE_BR_CASE = "Text<br>More<br>| A | B |\n|---|---|\n| 1 | 2 |<br>after"
+INLINE_BR_BLOCKS = [("text", "Text\nMore"), ("table", ["A", "B"], [["1", "2"]]), ("text", "after")]
+
+
+def blocks_summary(blocks):
+    return [(b["type"], b["text"]) if b["type"] == "text" else (b["type"], b["header"], b["rows"]) for b in blocks]
+
+
+def timed(parse, text):
+    start = time.perf_counter()
+    parse(text)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    sizes = [float(arg) for arg in sys.argv[1:]] or SIZES_MB
+    assert blocks_summary(parse_blocks(INLINE_BR_CASE)) == INLINE_BR_BLOCKS, parse_blocks(INLINE_BR_CASE)
+
+    print(f"{'Size (MB)':>10} {'old (s)':>10} {'parse_blocks (s)':>17} {'Blocks':>8}")
+    for size_mb in sizes:
+        text = synthetic_response(size_mb)
+        old = timed(old_parse, text)
+        new = timed(parse_blocks, text)
+        print(f"{len(text) / 1024 / 1024:>10.1f} {old:>10.3f} {new:>17.3f} {len(parse_blocks(text)):>8}")
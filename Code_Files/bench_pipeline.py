@@ -0,0 +1,264 @@
+import os
+
+# Everything runs offline against the fake model client, with the quotas out of the
+# way so the timings are the pipeline's own. Set before the modules below read them.
+os.environ.setdefault("MODEL_CLIENT", "fake")
+for quota in ("MODEL_RPM", "MODEL_TPM", "FILES_RPM", "EMBED_RPM", "EMBED_TPM"):
+    os.environ.setdefault(quota, "1000000000")
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import tempfile
+import time
+from datetime import datetime, timezone
+from functools import partial
+from docx import Document as WordDoc
+from bench_docx import PARAGRAPHS_PER_SECTION, TABLE_ROWS, synthetic_docx
+from doc_prep import prepare_documents
+from markdown_parser import parse_blocks
+from model_client import FakeClient
+from question_executor import ask_question, iter_questions
+from rate_limit import RateLimitedModel, throttled
+from template_filler import TemplateFiller, insert_element_after, table_element
+from upload_cache import UploadCache
+from vector_search import get_pdf_text, get_text_chunks, get_vector_store, retrieve_passages, update_vector_store
+
+# Pages of synthetic RFP and placeholders in the synthetic template, every pair is run
+PAGE_COUNTS = [10, 100, 1000]
+PLACEHOLDER_COUNTS = [100, 500]
+FORMATS = ["pdf", "docx"]
+
+# Fake model and file API timings in seconds
+MODEL_LATENCY = 0.05
+UPLOAD_LATENCY = 0.2
+PROCESSING_TIME = 1.0
+
+# Every third answer carries a table of this many rows
+ANSWER_TABLE_ROWS = 20
+
+# Pages of the addendum ingested on top of the RFP, and questions retrieved for afterwards
+ADDENDUM_PAGES = 5
+RETRIEVAL_QUESTIONS = 20
+
+# JSON keys, in pipeline order. extract_tables_and_text is now parse_blocks,
+# and save_uploaded_files, convert_docx, upload_to_gemini and
+# wait_for_files_active are the stages of prepare_documents.
+STAGES = ["save_uploaded_files", "convert_docx", "upload_to_gemini", "wait_for_files_active", "question_execution",
+          "extract_tables_and_text", "fill_template", "table_insertion", "update_vector_store",
+          "reingest_vector_store", "retrieve_passages", "get_pdf_text", "get_text_chunks", "get_vector_store"]
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def synthetic_pdf(path, pages, label):
+    """ A text-only PDF of a heading, clauses and table rows per page, written without a PDF library """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        lines = [f"Tender {label} Section {page}: Leak detection scope"]
+        lines += [f"Clause {page}.{p}: the vendor shall configure PipelineManager for every listed pipeline "
+                  f"and provide training, hardware and a leak sensitivity study." for p in range(PARAGRAPHS_PER_SECTION)]
+        lines += [f"Pipeline {page}-{r} | {r * 7} km | HSD | Tap-off at km {r}" for r in range(TABLE_ROWS)]
+        stream = "BT /F1 8 Tf 11 TL 40 800 Td " + " ".join(f"({_pdf_escape(line)}) '" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode("latin-1"))
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {len(objects)} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> >> >>".encode("latin-1"))
+        kids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {pages} >>".encode("latin-1")
+
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode("latin-1") + body + b"\nendobj\n"
+    xref_at = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    out += b"".join(f"{offset:010d} 00000 n \n".encode("latin-1") for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def synthetic_rfp(path, rfp_format, pages, label):
+    if rfp_format == "pdf":
+        synthetic_pdf(path, pages, label)
+    else:
+        # A section of bench_docx's tender document is about a page
+        synthetic_docx(path, pages, f"Tender {label} ")
+
+
+def synthetic_template(path, placeholders):
+    """ A proposal template with each placeholder in its own body paragraph, every tenth in a table cell """
+    doc = WordDoc()
+    doc.sections[0].header.paragraphs[0].text = "Proposal for <<Field 0>>"
+    table = doc.add_table(rows=0, cols=2)
+    for i in range(placeholders):
+        if i % 10 == 0:
+            row = table.add_row()
+            row.cells[0].text = f"Field {i}"
+            row.cells[1].text = f"<<Field {i}>>"
+            continue
+        doc.add_heading(f"Field {i}", level=2)
+        doc.add_paragraph(f"<<Field {i}>>")
+    doc.save(path)
+
+
+def synthetic_questions(placeholders):
+    """ One question per placeholder, and canned answers to them: prose, with a table every third one """
+    questions, answers = [], {}
+    for i in range(placeholders):
+        question = f"What is required for field {i}?"
+        questions.append({"question": question, "tag": f"<<Field {i}>>"})
+        answer = f"Field {i} covers the pipelines below.\nEach needs a model configured in PipelineManager."
+        if i % 3 == 0:
+            answer += ("\n\n| Pipeline | Length (km) | Product |\n|---|---:|---|\n"
+                       + "".join(f"| Pipeline {i}-{r} | {r * 7} | HSD |\n" for r in range(ANSWER_TABLE_ROWS)))
+        answers[question] = answer
+    return questions, answers
+
+
+def timed(fn, *args, **kwargs):
+    """ (result, seconds) of one call """
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_pipeline(work_dir, rfp_format, pages, placeholders, options):
+    """ One synthetic RFP and template through every stage, returning {stage: seconds} and counts """
+    label = f"{rfp_format}-{pages}-{placeholders}"
+    run_dir = os.path.join(work_dir, label)
+    os.makedirs(run_dir)
+    rfp_path = os.path.join(run_dir, f"rfp.{rfp_format}")
+    template_path = os.path.join(run_dir, "template.docx")
+    synthetic_rfp(rfp_path, rfp_format, pages, label)
+    synthetic_template(template_path, placeholders)
+    questions, answers = synthetic_questions(placeholders)
+
+    client = FakeClient(latency=options.latency, answers=answers,
+                        upload_latency=options.upload_latency, processing_time=options.processing_time)
+    stages = dict.fromkeys(STAGES)
+
+    # Upload stages, as the app runs them
+    with open(rfp_path, "rb") as f:
+        uploaded_file = io.BytesIO(f.read())
+    uploaded_file.name = os.path.basename(rfp_path)
+    get_file = throttled(client.get_file, "files")
+    upload_cache = UploadCache(throttled(client.upload, "files"), get_file, path=os.path.join(run_dir, "uploads.json"))
+    [prepared] = prepare_documents([uploaded_file], upload_cache, get_file, upload_dir=os.path.join(run_dir, "Uploaded_Docs"))
+    for stage, prep_stage in [("save_uploaded_files", "write"), ("convert_docx", "convert"),
+                              ("upload_to_gemini", "upload"), ("wait_for_files_active", "processing")]:
+        stages[stage] = prepared["timings"][prep_stage]
+
+    model = RateLimitedModel(client.model("fake"))
+    ask = partial(ask_question, model, [prepared["remote"]])
+    answered, stages["question_execution"] = timed(lambda: sorted(iter_questions(ask, questions), key=lambda pair: pair[0]))
+    responses = [item for _, item in answered]
+
+    blocks, stages["extract_tables_and_text"] = timed(lambda: [parse_blocks(item["response"]) for item in responses])
+
+    def fill():
+        filler = TemplateFiller(template_path)
+        for item in responses:
+            filler.fill(item)
+        filler.save(os.path.join(run_dir, "filled_template.docx"))
+    _, stages["fill_template"] = timed(fill)
+
+    # Tables alone, inserted one after another into an empty document
+    tables = [block for item_blocks in blocks for block in item_blocks if block["type"] == "table"]
+
+    def insert_tables():
+        doc = WordDoc()
+        anchor = doc.add_paragraph()._p
+        for block in tables:
+            anchor = insert_element_after(anchor, table_element(block))
+    _, stages["table_insertion"] = timed(insert_tables)
+
+    # Incremental ingestion the app uses: the RFP, then an addendum on top of the saved
+    # index, and retrieval from it. The whole-text path follows for PDFs.
+    index_path = os.path.join(run_dir, "rfp_index")
+    changes, stages["update_vector_store"] = timed(update_vector_store, [rfp_path], index_path=index_path)
+    addendum_path = os.path.join(run_dir, f"addendum.{rfp_format}")
+    synthetic_rfp(addendum_path, rfp_format, ADDENDUM_PAGES, label + "-addendum")
+    _, stages["reingest_vector_store"] = timed(update_vector_store, [rfp_path, addendum_path], index_path=index_path)
+    passages, stages["retrieve_passages"] = timed(
+        lambda: [retrieve_passages(item["question"], index_path=index_path) for item in questions[:RETRIEVAL_QUESTIONS]])
+    chunk_count = None
+    if rfp_format == "pdf":
+        text, stages["get_pdf_text"] = timed(get_pdf_text, [rfp_path])
+        chunks, stages["get_text_chunks"] = timed(get_text_chunks, text)
+        _, stages["get_vector_store"] = timed(get_vector_store, chunks)
+        chunk_count = len(chunks)
+
+    return {
+        "format": rfp_format,
+        "pages": pages,
+        "placeholders": placeholders,
+        "rfp_mb": os.path.getsize(rfp_path) / 1024 / 1024,
+        "stages": stages,
+        "total": sum(seconds for seconds in stages.values() if seconds is not None),
+        "counts": {
+            "tables": len(tables),
+            "index_chunks": changes["added"],
+            "passages": sum(len(found) for found in passages),
+            "text_chunks": chunk_count,
+            **client.usage.snapshot(),
+        },
+    }
+
+
+def bench_options(argv=None):
+    parser = argparse.ArgumentParser(description="Time every stage of the RFP to proposal pipeline offline")
+    parser.add_argument("--pages", type=int, nargs="+", default=PAGE_COUNTS, help="Synthetic RFP sizes in pages")
+    parser.add_argument("--placeholders", type=int, nargs="+", default=PLACEHOLDER_COUNTS,
+                        help="Placeholders in the synthetic template")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=FORMATS)
+    parser.add_argument("--latency", type=float, default=MODEL_LATENCY, help="Fake model seconds per request")
+    parser.add_argument("--upload-latency", type=float, default=UPLOAD_LATENCY, help="Fake upload seconds")
+    parser.add_argument("--processing-time", type=float, default=PROCESSING_TIME,
+                        help="Fake seconds before an upload is active")
+    parser.add_argument("--output", default="bench_pipeline.json", help="Where to write the JSON results")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    options = bench_options()
+    output_path = os.path.abspath(options.output)
+
+    runs = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The caches and indexes the pipeline keeps in the working directory start empty
+        os.chdir(work_dir)
+        print(f"{'Format':<7} {'Pages':>6} {'Tags':>5} " + " ".join(f"{stage[:12]:>12}" for stage in STAGES) + f" {'Total':>8}")
+        for rfp_format in options.formats:
+            for pages in options.pages:
+                for placeholders in options.placeholders:
+                    # The pipeline's own progress output would bury the table
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                        run = run_pipeline(work_dir, rfp_format, pages, placeholders, options)
+                    runs.append(run)
+                    cells = " ".join(f"{'-':>12}" if run["stages"][stage] is None else f"{run['stages'][stage]:>12.3f}"
+                                     for stage in STAGES)
+                    print(f"{rfp_format:<7} {pages:>6} {placeholders:>5} {cells} {run['total']:>8.2f}")
+
+    results = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "model_latency": options.latency,
+            "upload_latency": options.upload_latency,
+            "processing_time": options.processing_time,
+            "answer_table_rows": ANSWER_TABLE_ROWS,
+        },
+        "stages": STAGES,
+        "runs": runs,
+    }
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output_path}")
@@ -0,0 +1,52 @@
+import sys
+import time
+from docx import Document as WordDoc
+from template_filler import build_table_element
+
+# Row counts to compare, pass others on the command line: python bench_tables.py 500 5000
+ROW_COUNTS = [50, 100, 200, 1000, 5000, 20000]
+COLUMNS = 6
+
+# The cell-by-cell writer is quadratic, above this it takes minutes and is skipped
+CELL_BY_CELL_MAX_ROWS = 200
+
+
+def cell_by_cell_table(headers, rows):
+    """ The previous table writer: a throwaway document and one table.cell() call per cell """
+    temp_doc = WordDoc()
+    table = temp_doc.add_table(rows=len(rows) + 1, cols=len(headers))
+    table.style = 'Table Grid'
+
+    for i, header in enumerate(headers):
+        table.cell(0, i).text = header
+
+    for row_idx, row in enumerate(rows):
+        for col_idx, cell_text in enumerate(row):
+            table.cell(row_idx + 1, col_idx).text = cell_text
+
+    return table._element
+
+
+def timed(build, headers, rows):
+    start = time.perf_counter()
+    build(headers, rows)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    row_counts = [int(arg) for arg in sys.argv[1:]] or ROW_COUNTS
+    headers = [f"Column {c}" for c in range(COLUMNS)]
+
+    # Warm up the shared scratch document
+    build_table_element(headers, [])
+
+    print(f"{'Rows':>8} {'cell() (s)':>12} {'one pass (s)':>14} {'Speed-up':>10}")
+    for row_count in row_counts:
+        rows = [[f"Pipeline {r} value {c}" for c in range(COLUMNS)] for r in range(row_count)]
+        new = timed(build_table_element, headers, rows)
+        if row_count > CELL_BY_CELL_MAX_ROWS:
+            print(f"{row_count:>8} {'-':>12} {new:>14.3f} {'-':>10}")
+            continue
+
+        old = timed(cell_by_cell_table, headers, rows)
+        print(f"{row_count:>8} {old:>12.3f} {new:>14.3f} {old / new:>9.1f}x")
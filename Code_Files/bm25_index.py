@@ -0,0 +1,111 @@
+import heapq
+import json
+import math
+import os
+import re
+from collections import Counter
+
+BM25_FILE = "bm25.json"
+
+# Standard BM25 term-frequency saturation and length normalisation
+K1 = 1.5
+B = 0.75
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+class BM25Index:
+    """ Inverted index of chunks for exact-term lookups
+
+    Chunks are numbered rows. Each term keeps a postings list of
+    [row, term frequency] pairs, and only the terms of a query are visited
+    when it is scored.
+    """
+
+    def __init__(self, ids=None, lengths=None, postings=None):
+        self.ids = ids or []            # row -> chunk id
+        self.lengths = lengths or []    # row -> tokens in the chunk
+        self.postings = postings or {}  # term -> [[row, tf], ...]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, items):
+        """ Index (chunk id, text) pairs """
+        for cid, text in items:
+            row = len(self.ids)
+            tokens = tokenize(text)
+            self.ids.append(cid)
+            self.lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                self.postings.setdefault(term, []).append([row, tf])
+
+    def remove(self, cids):
+        """ Drop chunks by id, renumbering the remaining rows """
+        cids = set(cids)
+        if not cids:
+            return
+
+        new_row, ids, lengths = {}, [], []
+        for row, cid in enumerate(self.ids):
+            if cid not in cids:
+                new_row[row] = len(ids)
+                ids.append(cid)
+                lengths.append(self.lengths[row])
+
+        postings = {}
+        for term, plist in self.postings.items():
+            kept = [[new_row[row], tf] for row, tf in plist if row in new_row]
+            if kept:
+                postings[term] = kept
+        self.ids, self.lengths, self.postings = ids, lengths, postings
+
+    def search(self, query, k=4):
+        """ The k best (chunk id, score) pairs for query, best first """
+        count = len(self.ids)
+        if not count:
+            return []
+        avg_length = sum(self.lengths) / count
+
+        scores = Counter()
+        for term in set(tokenize(query)):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = math.log(1 + (count - len(plist) + 0.5) / (len(plist) + 0.5))
+            for row, tf in plist:
+                norm = K1 * (1 - B + B * self.lengths[row] / avg_length)
+                scores[row] += idf * tf * (K1 + 1) / (tf + norm)
+
+        return [(self.ids[row], score) for row, score in heapq.nlargest(k, scores.items(), key=lambda item: item[1])]
+
+    def save(self, index_path):
+        with open(os.path.join(index_path, BM25_FILE), "w") as f:
+            json.dump({"ids": self.ids, "lengths": self.lengths, "postings": self.postings}, f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, index_path):
+        """ The saved index, or None if there is none """
+        path = os.path.join(index_path, BM25_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            saved = json.load(f)
+        return cls(saved["ids"], saved["lengths"], saved["postings"])
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """ Fuse ranked lists of ids into one, best first
+
+    Each list adds 1 / (k + rank) to an id, so BM25 and vector scores,
+    which are on unrelated scales, only contribute through their ranks.
+    """
+    fused = Counter()
+    for ranking in rankings:
+        for rank, cid in enumerate(ranking, start=1):
+            fused[cid] += 1 / (k + rank)
+    return [cid for cid, _ in fused.most_common()]
@@ -0,0 +1,156 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from docx2pdf import convert
+from docx_extract import docx_to_markdown
+from file_waiter import wait_for_file, DEADLINE
+from upload_cache import file_hash
+
+UPLOAD_DIR = "Uploaded_Docs"
+
+# Documents prepared at once, and how many of them may be converting:
+# a PDF converter is a whole office process, uploads and polling are just I/O
+MAX_WORKERS = 4
+CONVERT_WORKERS = 2
+CONVERT_TIMEOUT = 300
+
+# docx2pdf attaches to the one shared Word instance and quits it when done, so its
+# conversions run one at a time across the whole process, whichever job asks.
+# Only LibreOffice gets a profile of its own per call.
+_word_lock = threading.Lock()
+
+STAGES = ("write", "convert", "upload", "processing")
+
+
+@contextmanager
+def com_initialized():
+    """ COM set up for the calling thread, which docx2pdf needs off the main thread on Windows """
+    if sys.platform != "win32":
+        yield
+        return
+
+    import pythoncom
+    pythoncom.CoInitialize()
+    try:
+        yield
+    finally:
+        pythoncom.CoUninitialize()
+
+
+def docx2pdf_converter(docx_path, pdf_path):
+    """ Convert with docx2pdf, which drives Microsoft Word, from any thread """
+    with _word_lock, com_initialized():
+        convert(docx_path, pdf_path)
+
+
+def libreoffice_converter(docx_path, pdf_path):
+    """ Convert with headless LibreOffice
+
+    Each call gets its own profile directory, LibreOffice refuses to run two
+    conversions against the same one.
+    """
+    soffice = shutil.which("soffice") or shutil.which("libreoffice") or "soffice"
+    with tempfile.TemporaryDirectory() as profile, tempfile.TemporaryDirectory() as out_dir:
+        subprocess.run(
+            [soffice, f"-env:UserInstallation={Path(profile).as_uri()}", "--headless",
+             "--convert-to", "pdf", "--outdir", out_dir, docx_path],
+            check=True, capture_output=True, timeout=CONVERT_TIMEOUT
+        )
+        shutil.move(os.path.join(out_dir, Path(docx_path).stem + ".pdf"), pdf_path)
+
+
+# (convert(docx_path, out_path), output extension, upload mime type). "native" reads the
+# paragraphs and tables straight from the document XML and uploads them as text,
+# the others render a PDF. Any such tuple can be passed as the converter.
+CONVERTERS = {
+    "native": (docx_to_markdown, ".md", "text/plain"),
+    "docx2pdf": (docx2pdf_converter, ".pdf", "application/pdf"),
+    "libreoffice": (libreoffice_converter, ".pdf", "application/pdf"),
+}
+DOCX_CONVERTER = os.getenv("DOCX_CONVERTER", "native")
+
+
+def is_unchanged(path, data):
+    """ Check whether a saved file already holds exactly these bytes """
+    if not os.path.exists(path) or os.path.getsize(path) != len(data):
+        return False
+    return file_hash(path) == hashlib.sha256(data).hexdigest()
+
+
+def prepare_documents(uploaded_files, upload_cache, get_fn, converter=None, max_workers=MAX_WORKERS,
+                      upload_dir=UPLOAD_DIR, deadline=DEADLINE, upload=True):
+    """ Write, convert, upload and wait for each uploaded file, the files side by side
+
+    Every file runs through its stages on its own worker, so one file
+    uploads while the next converts, and each upload is polled as soon as
+    it lands. At most CONVERT_WORKERS conversions run at once. Files are
+    only rewritten and reconverted when their bytes changed, and
+    upload_cache skips uploads of content it has seen before. With
+    upload=False the files are only written, for callers that read them
+    locally, and "path" is the saved file.
+
+    Returns one record per file, in upload order:
+    {"name", "source" (the saved upload), "path" (what was uploaded),
+     "remote" (None if the upload failed), "timings": {stage: seconds}}
+    """
+    convert_fn, extension, converted_mime_type = converter or CONVERTERS[DOCX_CONVERTER]
+    convert_slots = threading.Semaphore(CONVERT_WORKERS)
+    deadline_at = time.monotonic() + deadline
+    os.makedirs(upload_dir, exist_ok=True)
+
+    def prepare(uploaded_file):
+        timings = dict.fromkeys(STAGES, 0.0)
+
+        start = time.perf_counter()
+        path = os.path.join(upload_dir, uploaded_file.name)
+        data = uploaded_file.getbuffer()
+        unchanged = is_unchanged(path, data)
+        if not unchanged:
+            with open(path, "wb") as f:
+                f.write(data)
+        timings["write"] = time.perf_counter() - start
+
+        source, mime_type = path, "application/pdf"
+        if not upload:
+            return {"name": uploaded_file.name, "source": source, "path": path, "remote": None, "timings": timings}
+
+        if path.endswith(".docx"):
+            out_path = path[:-len(".docx")] + extension
+            # Skip the conversion on reruns with the same document
+            if not (unchanged and os.path.exists(out_path)):
+                start = time.perf_counter()
+                with convert_slots:
+                    convert_fn(path, out_path)
+                timings["convert"] = time.perf_counter() - start
+            path, mime_type = out_path, converted_mime_type
+
+        start = time.perf_counter()
+        remote_file, ready = upload_cache.get_or_upload(path, mime_type)
+        timings["upload"] = time.perf_counter() - start
+
+        if remote_file is not None and not ready:
+            timings["processing"] = wait_for_file(remote_file.name, get_fn, deadline_at)
+            upload_cache.mark_active([remote_file])
+
+        return {"name": uploaded_file.name, "source": source, "path": path, "remote": remote_file, "timings": timings}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(prepare, uploaded_files))
+
+
+def print_stage_report(records, elapsed=None):
+    """ Print per-file stage timings, and the wall time they overlapped into """
+    print(f"{'File':<40}" + "".join(f"{stage.capitalize() + ' (s)':>16}" for stage in STAGES))
+    for record in records:
+        print(f"{record['name']:<40}" + "".join(f"{record['timings'][stage]:>16.2f}" for stage in STAGES))
+
+    total = sum(sum(record["timings"].values()) for record in records)
+    print(f"Stages took {total:.2f}s in total" + (f", {elapsed:.2f}s wall time" if elapsed is not None else ""))
@@ -0,0 +1,159 @@
+import re
+import zipfile
+from itertools import groupby
+from docx.oxml.ns import qn
+from lxml import etree
+
+W_P, W_TBL, W_TR, W_TC = qn("w:p"), qn("w:tbl"), qn("w:tr"), qn("w:tc")
+W_T, W_TAB, W_BR, W_CR = qn("w:t"), qn("w:tab"), qn("w:br"), qn("w:cr")
+W_RENDERED_BREAK = qn("w:lastRenderedPageBreak")
+W_TYPE = qn("w:type")
+MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+HEADER_FOOTER_PART = re.compile(r"^word/(header|footer)\d*\.xml$")
+
+# Raised whenever the extracted text changes, so chunks cached from older text are rebuilt
+EXTRACT_VERSION = 2
+
+
+def element_text(el):
+    """ Text of a w:p or w:tc, with tabs and line breaks kept
+
+    Paragraphs nested in it, such as a cell's or a text box's, each start a
+    new line, and the mc:Fallback copy Word keeps of a text box is skipped.
+    """
+    parts = []
+    if el.tag == W_P and el.find(".//" + W_P) is None:
+        # Plain paragraph, nothing nested to keep apart
+        for child in el.iter(W_T, W_TAB, W_BR, W_CR):
+            _append_text(parts, child)
+        return "".join(parts)
+
+    def walk(node):
+        for child in node:
+            if child.tag == MC_FALLBACK:
+                continue
+            if child.tag == W_P:
+                if parts and not parts[-1].endswith("\n"):
+                    parts.append("\n")
+                walk(child)
+            elif child.tag in (W_T, W_TAB, W_BR, W_CR):
+                _append_text(parts, child)
+            else:
+                walk(child)
+
+    walk(el)
+    return "".join(parts)
+
+
+def _append_text(parts, el):
+    if el.tag == W_T:
+        parts.append(el.text or "")
+    elif el.tag == W_TAB:
+        parts.append("\t")
+    elif el.get(W_TYPE) != "page":
+        parts.append("\n")
+
+
+def table_markdown(header, rows):
+    """ Markdown source of a table, in the form markdown_parser.parse_blocks reads back """
+    def line(cells):
+        return "| " + " | ".join(cell.replace("|", "\\|").replace("\n", "<br>") for cell in cells) + " |"
+    return "\n".join([line(header), "|" + "---|" * len(header), *(line(row) for row in rows)])
+
+
+def table_block(tbl):
+    """ A w:tbl as a table block shaped like parse_blocks output """
+    rows = [
+        [element_text(tc).strip() for tc in tr.iterchildren(W_TC)]
+        for tr in tbl.iterchildren(W_TR)
+    ]
+    rows = [row for row in rows if row] or [[""]]
+
+    # Merged cells leave rows short, pad them to the widest
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    header, body = rows[0], rows[1:]
+    return {"type": "table", "text": table_markdown(header, body), "header": header, "rows": body, "align": [None] * width}
+
+
+def _iter_part(stream):
+    """ Yield (page_no, block) for the top-level paragraphs and tables of one XML part
+
+    The part is parsed with iterparse and every block is freed once it is
+    yielded, so memory stays flat however long the document is. Pages are
+    counted from the breaks Word records when it last laid the document
+    out, which open the paragraph on the new page, or from explicit page
+    breaks, which end the paragraph before it, if it never did.
+    """
+    tables = paragraphs = 0
+    rendered_breaks = explicit_breaks = explicit_at_start = 0
+
+    for event, el in etree.iterparse(stream, events=("start", "end"), tag=(W_P, W_TBL, W_BR, W_RENDERED_BREAK)):
+        if event == "start":
+            if el.tag in (W_P, W_TBL) and not (tables or paragraphs):
+                explicit_at_start = explicit_breaks
+            if el.tag == W_TBL:
+                tables += 1
+            elif el.tag == W_P:
+                paragraphs += 1
+            continue
+
+        if el.tag == W_RENDERED_BREAK:
+            rendered_breaks += 1
+            continue
+        if el.tag == W_BR:
+            explicit_breaks += el.get(W_TYPE) == "page"
+            continue
+
+        if el.tag == W_TBL:
+            tables -= 1
+        else:
+            paragraphs -= 1
+        if tables or paragraphs:
+            # Part of an enclosing table or text box, read with it
+            continue
+
+        page_no = 1 + (rendered_breaks or explicit_at_start)
+        if el.tag == W_TBL:
+            yield page_no, table_block(el)
+        else:
+            text = element_text(el).strip()
+            if text:
+                yield page_no, {"type": "text", "text": text}
+
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+
+
+def iter_docx_blocks(source, include_headers=True):
+    """ Yield (page_no, block) for a .docx file path or file-like object, in document order
+
+    Blocks have the shape of markdown_parser.parse_blocks: text blocks
+    {"type": "text", "text"} and table blocks with "header", "rows" and the
+    markdown "text". Header and footer text comes first, on page 1.
+    """
+    with zipfile.ZipFile(source) as archive:
+        if include_headers:
+            for name in sorted(n for n in archive.namelist() if HEADER_FOOTER_PART.match(n)):
+                with archive.open(name) as part:
+                    for _, block in _iter_part(part):
+                        yield 1, block
+
+        with archive.open("word/document.xml") as part:
+            yield from _iter_part(part)
+
+
+def iter_docx_records(source, name):
+    """ (doc, page_no, text) records for the chunker, one per page, tables as markdown """
+    for page_no, blocks in groupby(iter_docx_blocks(source), key=lambda item: item[0]):
+        yield name, page_no, "\n\n".join(block["text"] for _, block in blocks) + "\n\n"
+
+
+def docx_to_markdown(source, out_path):
+    """ Write the document as markdown text for a plain text upload, returning out_path """
+    with open(out_path, "w", encoding="utf-8") as f:
+        for _, block in iter_docx_blocks(source):
+            f.write(block["text"] + "\n\n")
+    return out_path
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+STORE_PATH = "embedding_store"
+
+# Chunks per embedding request and requests in flight at once
+BATCH_SIZE = 100
+MAX_WORKERS = 4
+
+
+def content_key(kind, text, model_id=""):
+    """ Queries and documents are embedded differently, and each model has its own vectors, so they are stored apart """
+    return hashlib.sha256(f"{model_id}\0{kind}\0{text}".encode("utf-8")).hexdigest()
+
+
+def store_dir(model_id, root=STORE_PATH):
+    """ Each embedding model gets its own store, its vectors have their own dimension """
+    return os.path.join(root, re.sub(r"[^\w.-]", "_", model_id)) if model_id else root
+
+
+@contextmanager
+def file_lock(path):
+    """ Exclusive lock on path across processes, held for the with block """
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class EmbeddingStore:
+    """ On-disk content hash -> vector store
+
+    Vectors are appended to one float32 file that is read through a NumPy
+    memmap, and keys.json maps each content hash to its row. Several
+    processes may share a store: writers take a file lock, merge in the
+    keys saved by the others, and number new rows from where they land in
+    the file.
+    """
+
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        self.keys_path = os.path.join(path, "keys.json")
+        self.lock_path = os.path.join(path, "store.lock")
+        self.rows, self.dim = {}, None
+        self.keys_mtime = None
+        self._vectors = None
+        self._refresh()
+
+    def _refresh(self):
+        """ Pick up keys saved by another process since the last read """
+        try:
+            mtime = os.stat(self.keys_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.keys_mtime:
+            return
+        with open(self.keys_path, "r") as f:
+            saved = json.load(f)
+        self.rows.update(saved["rows"])
+        self.dim = self.dim or saved["dim"]
+        self.keys_mtime = mtime
+        self._vectors = None
+
+    def _map(self):
+        if self._vectors is None and self.rows:
+            # Rows past the last saved key, such as ones written just before a crash, are never read
+            row_count = os.path.getsize(self.vectors_path) // (self.dim * 4)
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(row_count, self.dim))
+        return self._vectors
+
+    def get(self, keys):
+        """ Vectors for the keys that are stored, as {key: list of floats} """
+        with self.lock:
+            self._refresh()
+            vectors = self._map()
+            return {key: vectors[self.rows[key]].tolist() for key in keys if key in self.rows}
+
+    def put(self, items):
+        """ Append {key: vector} pairs that are not stored yet """
+        with self.lock, file_lock(self.lock_path):
+            self._refresh()
+            new = [(key, vector) for key, vector in items.items() if key not in self.rows]
+            if not new:
+                return
+
+            block = np.asarray([vector for _, vector in new], dtype=np.float32)
+            self.dim = self.dim or block.shape[1]
+            if block.shape[1] != self.dim:
+                raise ValueError(f"Vectors of dimension {block.shape[1]} in a store of dimension {self.dim}")
+
+            # A half-written row left by a crashed writer is padded out, not overwritten,
+            # readers may have the file mapped
+            row_bytes = self.dim * 4
+            size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+            padding = -size % row_bytes
+            first_row = (size + padding) // row_bytes
+            with open(self.vectors_path, "ab") as f:
+                f.write(b"\0" * padding + block.tobytes())
+
+            for offset, (key, _) in enumerate(new):
+                self.rows[key] = first_row + offset
+            tmp_path = self.keys_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"dim": self.dim, "rows": self.rows}, f)
+            os.replace(tmp_path, self.keys_path)
+            self.keys_mtime = os.stat(self.keys_path).st_mtime_ns
+
+            # Re-map on the next read to see the appended rows
+            self._vectors = None
+
+
+class CachedEmbeddings(Embeddings):
+    """ Wraps an embedder so each distinct text is only ever embedded once
+
+    Texts missing from the store are sent to the wrapped embedder in batches
+    of batch_size, with up to max_workers batches in flight. model_id names
+    the embedding model, vectors are only reused for the same one.
+    """
+
+    def __init__(self, embedder, model_id, store=None, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS):
+        self.embedder = embedder
+        self.model_id = model_id
+        self.store = store or EmbeddingStore(store_dir(model_id))
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.stats = {"hits": 0, "embedded": 0, "requests": 0}
+
+    def embed_documents(self, texts):
+        keys = [content_key("document", text, self.model_id) for text in texts]
+        found = self.store.get(keys)
+
+        missing = list({key: text for key, text in zip(keys, texts) if key not in found}.items())
+        batches = [missing[start:start + self.batch_size] for start in range(0, len(missing), self.batch_size)]
+
+        def embed_batch(batch):
+            vectors = self.embedder.embed_documents([text for _, text in batch])
+            return dict(zip((key for key, _ in batch), vectors))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for embedded in executor.map(embed_batch, batches):
+                self.store.put(embedded)
+                found.update(embedded)
+
+        self.stats["hits"] += len(texts) - len(missing)
+        self.stats["embedded"] += len(missing)
+        self.stats["requests"] += len(batches)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text):
+        key = content_key("query", text, self.model_id)
+        found = self.store.get([key])
+        if key in found:
+            self.stats["hits"] += 1
+            return found[key]
+
+        vector = self.embedder.embed_query(text)
+        self.store.put({key: vector})
+        self.stats["embedded"] += 1
+        self.stats["requests"] += 1
+        return vector
+
+
+class FakeEmbeddings(Embeddings):
+    """ Deterministic offline embedder: the same text always gives the same unit vector """
+
+    def __init__(self, dim=768):
+        self.dim = dim
+        self.calls = 0
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        self.calls += 1
+        return self._vector(text)
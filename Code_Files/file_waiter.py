@@ -0,0 +1,47 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# First poll comes quickly so small documents are picked up within about a second,
+# later polls back off towards the old fixed 10 second interval
+INITIAL_INTERVAL = 0.5
+MAX_INTERVAL = 10
+BACKOFF = 2
+DEADLINE = 600
+
+
+def wait_for_file(name, get_fn, deadline_at, initial_interval=INITIAL_INTERVAL,
+                  max_interval=MAX_INTERVAL, backoff=BACKOFF):
+    """ Poll one file until it leaves PROCESSING, returning the seconds it took """
+    start = time.monotonic()
+    interval = initial_interval
+
+    file = get_fn(name)
+    while file.state.name == "PROCESSING":
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise Exception(f"File {name} was not ready before the deadline")
+
+        time.sleep(min(interval, remaining))
+        interval = min(interval * backoff, max_interval)
+        file = get_fn(name)
+
+    if file.state.name != "ACTIVE":
+        raise Exception(f"File {file.name} failed to process")
+
+    return time.monotonic() - start
+
+
+def wait_until_active(files, get_fn, deadline=DEADLINE, **poll_options):
+    """ Wait for all files concurrently and return {file name: seconds until ready}
+
+    get_fn(name) fetches the current file status, normally client.get_file.
+    Raises if any file fails or the overall deadline passes.
+    """
+    names = [file.name for file in files]
+    if not names:
+        return {}
+
+    deadline_at = time.monotonic() + deadline
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        timings = executor.map(lambda name: wait_for_file(name, get_fn, deadline_at, **poll_options), names)
+        return dict(zip(names, timings))
@@ -0,0 +1,252 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+QUEUE_PATH = ".jobs.sqlite"
+JOBS_DIR = "jobs"
+
+# Jobs run at once across all users
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+# Idle workers check for new jobs this often
+IDLE_POLL = 0.5
+
+# Finished jobs and their working directories are removed after a week
+MAX_AGE = 7 * 24 * 60 * 60
+
+# Each queue marks the jobs its workers are running as alive this often, and a
+# running job not marked for STALE_AFTER seconds lost its worker and is queued again
+HEARTBEAT_INTERVAL = 10
+STALE_AFTER = 60
+
+
+def upload_key(uploaded_files, *extra):
+    """ Job key from the uploaded files' names and bytes plus any run options """
+    digest = hashlib.sha256()
+    for uploaded_file in uploaded_files:
+        digest.update(uploaded_file.name.encode("utf-8") + b"\0")
+        digest.update(hashlib.sha256(uploaded_file.getvalue()).digest())
+    for value in extra:
+        digest.update(repr(value).encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+class Job:
+    """ What a handler sees of the job it runs """
+
+    def __init__(self, queue, row):
+        self.queue = queue
+        self.id = row["id"]
+        self.owner = row["owner"]
+        self.options = json.loads(row["options"])
+        self.workdir = os.path.join(queue.jobs_dir, self.id)
+
+    def input_files(self):
+        """ The uploaded files, as in-memory file objects with a name like Streamlit's """
+        input_dir = os.path.join(self.workdir, "input")
+        files = []
+        for name in sorted(os.listdir(input_dir)):
+            with open(os.path.join(input_dir, name), "rb") as f:
+                uploaded_file = io.BytesIO(f.read())
+            uploaded_file.name = name
+            files.append(uploaded_file)
+        return files
+
+    def update(self, stage=None, **results):
+        self.queue.update(self.id, stage, results)
+
+
+class JobQueue:
+    """ SQLite-backed queue of jobs run by a pool of worker threads
+
+    Every job gets its own working directory under jobs_dir, holding its
+    inputs and everything it writes. Workers take the next queued job from
+    the owner with the fewest jobs running, then the owner served least
+    recently, oldest job first, so one user submitting many proposals
+    takes turns with everyone else instead of holding them up.
+    handlers maps a job kind to a function handler(job).
+
+    Several queues may share the database, from a rebuilt Streamlit cache
+    or a second process. Each claimed job records which queue runs it and
+    a heartbeat, and only jobs whose heartbeat stopped are run again.
+    """
+
+    def __init__(self, handlers, path=QUEUE_PATH, jobs_dir=JOBS_DIR, workers=JOB_WORKERS):
+        self.handlers = handlers
+        self.path = path
+        self.jobs_dir = jobs_dir
+        self.workers = workers
+        self.threads = []
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        os.makedirs(jobs_dir, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, owner TEXT NOT NULL, key TEXT NOT NULL, kind TEXT NOT NULL, "
+                "options TEXT NOT NULL, status TEXT NOT NULL, stage TEXT, results TEXT NOT NULL, error TEXT, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+            )
+            # Queues created before jobs had a worker and heartbeat
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("worker", "TEXT"), ("heartbeat", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, owner, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+
+    def _connect(self):
+        # A connection per call, used from the UI and every worker thread
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def start(self):
+        """ Start the workers and the heartbeat of the jobs they run """
+        self.evict()
+
+        for target in [self._heartbeat] + [self._work] * self.workers:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def _heartbeat(self):
+        while True:
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE jobs SET heartbeat = ? WHERE worker = ? AND status = 'running'",
+                    (time.time(), self.worker_id)
+                )
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def submit(self, owner, key, kind, files, options, reuse_done=True):
+        """ Queue a job for (name, bytes) files and return its id
+
+        A job with the same key that is queued or running is reused instead,
+        whoever submitted it, and so is a finished one unless reuse_done is
+        False. The key must cover every input the job's result depends on.
+        """
+        statuses = ("queued", "running", "done") if reuse_done else ("queued", "running")
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT id FROM jobs WHERE key = ? AND status IN ({', '.join('?' * len(statuses))}) "
+                "ORDER BY created_at DESC LIMIT 1", (key, *statuses)
+            ).fetchone()
+        if row is not None:
+            return row["id"]
+
+        job_id = uuid.uuid4().hex
+        input_dir = os.path.join(self.jobs_dir, job_id, "input")
+        os.makedirs(input_dir)
+        for name, data in files:
+            with open(os.path.join(input_dir, os.path.basename(name)), "wb") as f:
+                f.write(data)
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, owner, key, kind, options, status, stage, results, created_at) "
+                "VALUES (?, ?, ?, ?, ?, 'queued', 'Queued', '{}', ?)",
+                (job_id, owner, key, kind, json.dumps(options), time.time())
+            )
+        return job_id
+
+    def _claim(self):
+        """ Mark the fairest queued job running and return it, or None """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Jobs cut off by a restart or crash, whose queue stopped marking them alive
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, worker = NULL "
+                "WHERE status = 'running' AND COALESCE(heartbeat, 0) < ?", (time.time() - STALE_AFTER,)
+            )
+            row = conn.execute(
+                "SELECT * FROM jobs AS queued WHERE status = 'queued' ORDER BY "
+                "(SELECT COUNT(*) FROM jobs AS running WHERE running.owner = queued.owner "
+                "AND running.status = 'running'), "
+                "(SELECT COALESCE(MAX(started_at), 0) FROM jobs AS served WHERE served.owner = queued.owner), "
+                "created_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                now = time.time()
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', stage = 'Starting', started_at = ?, worker = ?, heartbeat = ? "
+                    "WHERE id = ?",
+                    (now, self.worker_id, now, row["id"])
+                )
+            conn.execute("COMMIT")
+        return row
+
+    def _work(self):
+        while True:
+            row = self._claim()
+            if row is None:
+                time.sleep(IDLE_POLL)
+                continue
+
+            try:
+                self.handlers[row["kind"]](Job(self, row))
+                status, error = "done", None
+            except Exception as e:
+                traceback.print_exc()
+                status, error = "failed", str(e)
+
+            # A job requeued while this worker was stalled belongs to its new worker
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND worker = ?",
+                    (status, error, time.time(), row["id"], self.worker_id)
+                )
+
+    def update(self, job_id, stage=None, results=None):
+        """ Record a job's stage and merge results, which must be JSON serialisable """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT results FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            merged = {**json.loads(row["results"]), **(results or {})}
+            conn.execute(
+                "UPDATE jobs SET stage = COALESCE(?, stage), results = ? WHERE id = ?",
+                (stage, json.dumps(merged), job_id)
+            )
+            conn.execute("COMMIT")
+
+    def snapshot(self, job_id):
+        """ The job's status, stage, error, elapsed seconds, place in the queue and results """
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            ahead = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (row["created_at"],)
+            ).fetchone()[0]
+
+        start = row["started_at"] or row["created_at"]
+        return {
+            "id": row["id"],
+            "status": row["status"],
+            "stage": row["stage"],
+            "error": row["error"],
+            "elapsed": (row["finished_at"] or time.time()) - start,
+            "ahead": ahead if row["status"] == "queued" else 0,
+            "workdir": os.path.join(self.jobs_dir, row["id"]),
+            **json.loads(row["results"]),
+        }
+
+    def evict(self, max_age=MAX_AGE):
+        """ Remove finished jobs older than max_age along with their working directories """
+        cutoff = time.time() - max_age
+        with self._connect() as conn:
+            old = [row["id"] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,)
+            )]
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in old])
+        for job_id in old:
+            shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
@@ -1,20 +1,22 @@
 import os
-import time
-import google.generativeai as genai
 from docx import Document
 from dotenv import load_dotenv
-import re
+from file_waiter import wait_until_active
+from markdown_parser import parse_blocks
+from model_client import get_client
+from rate_limit import RateLimitedModel, throttled
+from template_filler import table_element
 
 load_dotenv()
 GEMINI_API_KEY =os.getenv("GEMINI_API_KEY_2")
 
-# Configure Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
+# Gemini API client, or an offline fake with MODEL_CLIENT=fake
+client = get_client(GEMINI_API_KEY)
 
 def upload_to_gemini(path, mime_type="application/pdf"):
     """Uploads a file to Gemini and returns the file object."""
     try:
-        file = genai.upload_file(path, mime_type=mime_type)
+        file = throttled(client.upload, "files")(path, mime_type=mime_type)
         print(f"Uploaded file '{file.display_name}' as: {file.uri}")
         return file
     except Exception as e:
@@ -24,90 +26,15 @@ def upload_to_gemini(path, mime_type="application/pdf"):
 def wait_for_files_active(files):
     """Waits for the uploaded files to become active before use."""
     print("Waiting for file processing...")
-    for name in (file.name for file in files):
-        file = genai.get_file(name)
-        while file.state.name == "PROCESSING":
-            print(".", end="", flush=True)
-            time.sleep(10)
-            file = genai.get_file(name)
-        if file.state.name != "ACTIVE":
-            raise Exception(f"File {file.name} failed to process")
+    timings = wait_until_active(files, throttled(client.get_file, "files"))
+    for name, seconds in timings.items():
+        print(f"{name} ready after {seconds:.1f}s")
     print("...all files ready\n")
+    return timings
 
-def extract_tables_and_text(text):
-
-    # Split text at <br> (which separates tables in Gemini output)
-    sections = re.split(r'<br\s*/?>', text)
-
-    extracted_tables = []
-    before_table = ""
-    after_table = ""
-    table_found = False
-
-    for section in sections:
-        lines = section.strip().split("\n")
-        table_lines = []
-        inside_table = False
-
-        for line in lines:
-            if "|" in line:  # Detect table start
-                table_lines.append(line)
-                inside_table = True
-            elif inside_table and line.strip():  # Handle mis-formatted rows
-                table_lines.append(line)
-            elif inside_table and not line.strip():  # Table ends when empty line appears
-                inside_table = False
-            elif inside_table:
-                table_lines.append(line)  # Handle any edge cases
-            elif not table_found:  # Text before first table
-                before_table += line + "\n"
-            else:  # Text after last table
-                after_table += line + "\n"
-
-        if table_lines:
-            extracted_tables.append("\n".join(table_lines).strip())
-            table_found = True
-
-    return before_table.strip(), extracted_tables, after_table.strip()
-
-
-def add_table_to_word(doc, table_text):
-
-    if not table_text:
-        return doc  # No table detected
-
-    lines = table_text.strip().split("\n")
-
-    # Ensure at least two rows (headers + data)
-    if len(lines) < 2:
-        return doc
-
-    # Extract headers and rows
-    headers = lines[0].split("|")[1:-1]  # Remove first and last empty elements
-    headers = [h.strip() for h in headers]
-
-    rows = []
-    for line in lines[2:]:  # Skip headers and separator row
-        columns = line.split("|")[1:-1]
-        if len(columns) == len(headers):  # Ensure row matches header count
-            rows.append([col.strip() for col in columns])
-
-    if not rows:
-        return doc  # No valid table rows
-
-    # Create Word table
-    table = doc.add_table(rows=len(rows) + 1, cols=len(headers))
-    table.style = 'Table Grid'
-
-    # Add headers
-    for i, header in enumerate(headers):
-        table.cell(0, i).text = header
-
-    # Add rows
-    for row_idx, row in enumerate(rows):
-        for col_idx, cell_text in enumerate(row):
-            table.cell(row_idx + 1, col_idx).text = cell_text
-
+def add_table_to_word(doc, table):
+    """Appends a parsed table block to the end of the document."""
+    doc.element.body._insert_tbl(table_element(table))
     return doc
 
 
@@ -120,8 +47,8 @@ generation_config = {
     "response_mime_type": "text/plain",
 }
 
-# Create the model
-model = genai.GenerativeModel(
+# Create the model, its requests rate limited and retried
+model = RateLimitedModel(client.model(
     model_name="gemini-2.0-flash",
     generation_config=generation_config,
     # system_instruction="Please respond to the given question from the content provided. Make sure to give a concise, structured and summarized response so that it aligns with the questions requirement.",
@@ -133,7 +60,7 @@ model = genai.GenerativeModel(
     Avoid including example information, formulas, or unnecessary details in your answers.
     """
 
-)
+))
 
 #Don't include example information or formulas in the summary, but include tabular data wherever detected.
 #If there are 2 or more tables in response the separate the tables with an empty line.
@@ -224,15 +151,13 @@ for item in questions_with_tags:
     entry = {"question": question, "tag": tag, "response": response.text}
     data.append(entry)
 
-    before_text, tables, after_text = extract_tables_and_text(response.text)
-
-    if before_text:
-        doc.add_paragraph(before_text)
-    for table in tables:
-        add_table_to_word(doc, table)
-        doc.add_paragraph("\n")
-    if after_text:
-        doc.add_paragraph(after_text)
+    # Text and tables in the order they appear in the response
+    for block in parse_blocks(response.text):
+        if block["type"] == "table":
+            add_table_to_word(doc, block)
+            doc.add_paragraph("\n")
+        else:
+            doc.add_paragraph(block["text"])
 
     print(f"Response stored for tag {tag}.\n")
 
@@ -0,0 +1,159 @@
+import re
+
+# Gemini separates sections with <br> tags, on their own line or inline
+BR_LINE = re.compile(r"^\s*(<br\s*/?>\s*)+$", re.IGNORECASE)
+BR_TAG = re.compile(r"<br\s*/?>", re.IGNORECASE)
+TRAILING_BR = re.compile(r"(<br\s*/?>\s*)+$", re.IGNORECASE)
+
+# Cell separators are pipes that are not escaped as \|
+CELL_SPLIT = re.compile(r"(?<!\\)\|")
+ALIGNMENT_CELL = re.compile(r"^:?-+:?$")
+
+
+def split_row(line):
+    """ Split a table row into stripped cells, honouring escaped pipes """
+    line = line.strip()
+    if "<" in line:
+        line = TRAILING_BR.sub("", line)
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+
+    # Plain str methods on the common path, regexes only when the row needs them
+    if "\\" in line:
+        cells = [cell.replace("\\|", "|").strip() for cell in CELL_SPLIT.split(line)]
+    else:
+        cells = [cell.strip() for cell in line.split("|")]
+    if "<" in line:
+        cells = [BR_TAG.sub("\n", cell).strip() for cell in cells]
+    return cells
+
+
+def is_row(line):
+    if "|" not in line:
+        return False
+    return "\\" not in line or CELL_SPLIT.search(line) is not None
+
+
+def is_break(line):
+    return "<" in line and BR_LINE.match(line) is not None
+
+
+def split_breaks(line):
+    """ A line cut into separate lines at the <br> tags outside its table rows
+
+    Text on either side of an inline <br> is its own section, as when the
+    response was split on <br>, while a <br> inside a row's cells stays a
+    line break within the cell: a piece starting with a pipe runs on until
+    a piece ends with one.
+    """
+    if "<" not in line or is_break(line):
+        return [line]
+    body = TRAILING_BR.sub("", line)
+    if body.lstrip().startswith("|") and body.rstrip().endswith("|"):
+        # One row, trailing <br> and all
+        return [line]
+
+    parts, row = [], None
+    for piece in BR_TAG.split(body):
+        if row is not None:
+            row += "<br>" + piece
+            if piece.rstrip().endswith("|"):
+                parts.append(row)
+                row = None
+        elif piece.strip().startswith("|") and (piece.strip() == "|" or not piece.strip().endswith("|")):
+            # The start of a row with a <br> in one of its cells
+            row = piece
+        else:
+            parts.append(piece)
+    if row is not None:
+        parts.append(row)
+    return parts
+
+
+def is_alignment_row(line):
+    """ The |---|:---:| line under a table header """
+    if "-" not in line or not is_row(line):
+        return False
+    cells = split_row(line)
+    return all(ALIGNMENT_CELL.match(cell.replace(" ", "")) for cell in cells)
+
+
+def alignment_of(cell):
+    cell = cell.replace(" ", "")
+    if cell.startswith(":") and cell.endswith(":"):
+        return "center"
+    if cell.endswith(":"):
+        return "right"
+    if cell.startswith(":"):
+        return "left"
+    return None
+
+
+def _table_block(lines, has_alignment_row):
+    header = split_row(lines[0])
+    body = lines[2:] if has_alignment_row else lines[1:]
+    rows = [split_row(line) for line in body]
+
+    # Ragged rows are padded to the widest row rather than dropped
+    width = max([len(header), *(len(row) for row in rows)])
+    header += [""] * (width - len(header))
+    rows = [row + [""] * (width - len(row)) for row in rows]
+
+    align = [alignment_of(cell) for cell in split_row(lines[1])] if has_alignment_row else []
+    align += [None] * (width - len(align))
+
+    return {"type": "table", "text": "\n".join(lines), "header": header, "rows": rows, "align": align[:width]}
+
+
+def parse_blocks(text):
+    """ Split a model response into text and table blocks in document order
+
+    Text blocks are {"type": "text", "text": ...}. Table blocks are
+    {"type": "table", "text": <markdown source>, "header": [...], "rows": [[...]],
+    "align": [...]} with align entries of "left", "right", "center" or None.
+
+    A table is a header row followed by an alignment row, or at least two
+    consecutive lines that start with a pipe. Any other line with a pipe in
+    it stays text. Inline <br> tags outside table rows split a line first.
+    Each line is looked at a constant number of times.
+    """
+    lines = text.split("\n")
+    if "<" in text:
+        lines = [part for line in lines for part in split_breaks(line)]
+    blocks, text_lines = [], []
+
+    def flush_text():
+        joined = BR_TAG.sub("\n", "\n".join(text_lines)).strip()
+        if joined:
+            blocks.append({"type": "text", "text": joined})
+        text_lines.clear()
+
+    i, total = 0, len(lines)
+    while i < total:
+        line = lines[i]
+        if is_break(line):
+            # Section break, ends whatever table came before it
+            text_lines.append("")
+            i += 1
+            continue
+
+        next_line = lines[i + 1] if i + 1 < total else ""
+        has_alignment_row = is_row(line) and is_alignment_row(next_line)
+        pipe_table = line.lstrip().startswith("|") and next_line.lstrip().startswith("|")
+
+        if not (has_alignment_row or pipe_table):
+            text_lines.append(line)
+            i += 1
+            continue
+
+        flush_text()
+        end = i + 2
+        while end < total and is_row(lines[end]) and not is_break(lines[end]):
+            end += 1
+        blocks.append(_table_block(lines[i:end], has_alignment_row))
+        i = end
+
+    flush_text()
+    return blocks
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from types import SimpleNamespace
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+from langchain_core.language_models.chat_models import SimpleChatModel
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from embedding_store import FakeEmbeddings
+
+# "gemini" talks to the API, "fake" runs the whole pipeline offline
+MODEL_CLIENT = os.getenv("MODEL_CLIENT", "gemini")
+
+# Fake model seconds per request, and extra seconds per thousand prompt tokens
+FAKE_LATENCY = float(os.getenv("FAKE_LATENCY", "0.5"))
+FAKE_LATENCY_PER_1K = float(os.getenv("FAKE_LATENCY_PER_1K", "0.0"))
+
+EMBEDDING_MODEL = "models/embedding-001"
+
+
+class ModelClient(ABC):
+    """ Everything the scripts ask of a model provider
+
+    upload(path, mime_type) and get_file(name) return file handles with a
+    name, display_name, uri and state.name of PROCESSING, ACTIVE or FAILED.
+    model() returns a GenerativeModel-like object whose generate_content()
+    and start_chat().send_message() give responses with text and
+    usage_metadata, streamed if asked. embeddings() and chat_model() are the
+    LangChain embedder and chat model used by the vector search.
+
+    kind and embedding_id go into the answer and embedding cache keys, so
+    answers and vectors from one client are never served for another.
+    """
+
+    kind = None
+
+    @property
+    @abstractmethod
+    def embedding_id(self):
+        """ Names the embedder, vectors are only reused for the same one """
+
+    @abstractmethod
+    def upload(self, path, mime_type="application/pdf"):
+        pass
+
+    @abstractmethod
+    def get_file(self, name):
+        pass
+
+    @abstractmethod
+    def model(self, model_name, generation_config=None, system_instruction=None):
+        pass
+
+    @abstractmethod
+    def embeddings(self):
+        pass
+
+    @abstractmethod
+    def chat_model(self, model_name, temperature=0.3):
+        pass
+
+
+class GeminiClient(ModelClient):
+    kind = "gemini"
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+        genai.configure(api_key=api_key)
+
+    def upload(self, path, mime_type="application/pdf"):
+        return genai.upload_file(path, mime_type=mime_type)
+
+    def get_file(self, name):
+        return genai.get_file(name)
+
+    def model(self, model_name, generation_config=None, system_instruction=None):
+        return genai.GenerativeModel(model_name=model_name, generation_config=generation_config,
+                                     system_instruction=system_instruction)
+
+    @property
+    def embedding_id(self):
+        return f"{self.kind}/{EMBEDDING_MODEL}"
+
+    def embeddings(self):
+        return GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL, google_api_key=self.api_key)
+
+    def chat_model(self, model_name, temperature=0.3):
+        return ChatGoogleGenerativeAI(model=model_name, temperature=temperature, google_api_key=self.api_key)
+
+
+def token_count(part):
+    """ Fake token count of one prompt part: words of text, or the tokens a fake file was given """
+    if isinstance(part, FakeFile):
+        return part.tokens
+    return len(str(part).split())
+
+
+class FakeFile:
+    """ Uploaded file handle, PROCESSING until its processing time has passed """
+
+    def __init__(self, path, mime_type, ready_at):
+        with open(path, "rb") as f:
+            data = f.read()
+        self.name = "files/" + hashlib.sha256(data).hexdigest()[:16]
+        self.display_name = os.path.basename(path)
+        self.uri = "fake://" + self.name
+        self.mime_type = mime_type
+        self.size_bytes = len(data)
+        # About four bytes a token, as for extracted text
+        self.tokens = len(data) // 4
+        self.ready_at = ready_at
+
+    @property
+    def state(self):
+        return SimpleNamespace(name="ACTIVE" if time.monotonic() >= self.ready_at else "PROCESSING")
+
+
+class UsageCounters:
+    """ Thread-safe running totals of a fake client's requests, tokens and uploads """
+
+    def __init__(self):
+        self.totals = dict.fromkeys(("requests", "prompt_tokens", "output_tokens", "uploads"), 0)
+        self.lock = threading.Lock()
+
+    def add(self, **amounts):
+        with self.lock:
+            for name, amount in amounts.items():
+                self.totals[name] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.totals)
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens=0):
+        self.text = text
+        self.usage_metadata = FakeUsage(prompt_tokens, len(text.split()))
+
+    def __iter__(self):
+        # Streams as a single chunk
+        yield self
+
+
+class FakeChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = history
+
+    def send_message(self, contents, stream=False):
+        history_tokens = sum(len(" ".join(turn["parts"]).split()) for turn in self.history)
+        return self.model.generate_content(contents, history_tokens=history_tokens)
+
+
+class FakeModel:
+    """ Local stand-in for genai.GenerativeModel that answers after an artificial delay
+
+    Answers come from answers by question, or echo the question. Usage is
+    added up in usage, shared with the client that made the model.
+    """
+
+    def __init__(self, latency=0.5, answers=None, latency_per_1k=0.0, usage=None):
+        self.latency = latency
+        self.latency_per_1k = latency_per_1k
+        self.answers = answers or {}
+        self.usage = usage or UsageCounters()
+
+    def generate_content(self, contents, generation_config=None, stream=False, history_tokens=0):
+        question = contents[-1]
+        prompt_tokens = history_tokens + sum(token_count(part) for part in contents)
+        time.sleep(self.latency + self.latency_per_1k * prompt_tokens / 1000)
+
+        if (generation_config or {}).get("response_mime_type") == "application/json":
+            # Batch prompt: one "tag: question" per line after the instructions
+            answers = {}
+            for line in question.split("\n")[3:]:
+                tag, _, text = line.partition(": ")
+                answers[tag] = self.answers.get(text, f"Answer to: {text}")
+            response = FakeResponse(json.dumps(answers), prompt_tokens)
+        else:
+            response = FakeResponse(self.answers.get(question, f"Answer to: {question}"), prompt_tokens)
+
+        self.usage.add(requests=1, prompt_tokens=prompt_tokens,
+                       output_tokens=response.usage_metadata.candidates_token_count)
+        return response
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history or [])
+
+
+class FakeChatModel(SimpleChatModel):
+    """ LangChain chat model that answers with the size of the context it was given """
+
+    latency: float = 0.5
+
+    @property
+    def _llm_type(self):
+        return "fake"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return f"Answer from {len(messages[-1].content.split())} words of context"
+
+
+class FakeClient(ModelClient):
+    """ Offline, deterministic client for benchmarks and load tests
+
+    Uploads take upload_latency seconds and then process for
+    processing_time, model requests take latency plus latency_per_1k per
+    thousand prompt tokens, and embeddings are hash-seeded unit vectors.
+    """
+
+    kind = "fake"
+
+    def __init__(self, latency=FAKE_LATENCY, answers=None, latency_per_1k=FAKE_LATENCY_PER_1K,
+                 upload_latency=0.0, processing_time=0.0, embedding_dim=768):
+        self.latency = latency
+        self.latency_per_1k = latency_per_1k
+        self.answers = answers or {}
+        self.upload_latency = upload_latency
+        self.processing_time = processing_time
+        self.embedding_dim = embedding_dim
+        self.files = {}
+        self.usage = UsageCounters()
+
+    def upload(self, path, mime_type="application/pdf"):
+        time.sleep(self.upload_latency)
+        file = FakeFile(path, mime_type, time.monotonic() + self.processing_time)
+        self.files[file.name] = file
+        self.usage.add(uploads=1)
+        return file
+
+    def get_file(self, name):
+        if name not in self.files:
+            raise api_exceptions.NotFound(f"File {name} not found")
+        return self.files[name]
+
+    def model(self, model_name, generation_config=None, system_instruction=None):
+        return FakeModel(self.latency, self.answers, self.latency_per_1k, self.usage)
+
+    @property
+    def embedding_id(self):
+        return f"{self.kind}/{self.embedding_dim}"
+
+    def embeddings(self):
+        return FakeEmbeddings(self.embedding_dim)
+
+    def chat_model(self, model_name, temperature=0.3):
+        return FakeChatModel(latency=self.latency)
+
+
+@lru_cache(maxsize=None)
+def get_client(api_key=None, kind=None):
+    """ The process-wide client of this kind, MODEL_CLIENT by default """
+    kind = kind or MODEL_CLIENT
+    if kind == "fake":
+        return FakeClient()
+    if kind == "gemini":
+        return GeminiClient(api_key)
+    raise ValueError(f"Unknown model client {kind!r}, expected 'gemini' or 'fake'")
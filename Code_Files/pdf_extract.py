@@ -0,0 +1,51 @@
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from PyPDF2 import PdfReader
+
+# Pages handed to a worker at a time
+PAGES_PER_TASK = 16
+
+
+def extract_page_range(path, name, start, end):
+    """ Text of pages start..end-1 of one PDF as (doc, page_no, text) records, page_no from 1 """
+    reader = PdfReader(path)
+    return [(name, page_no + 1, reader.pages[page_no].extract_text() or "") for page_no in range(start, end)]
+
+
+def _as_paths(pdf_docs, tmp_dir):
+    """ (name, path) for each document, writing uploaded files to tmp_dir one at a time """
+    for pdf in pdf_docs:
+        if isinstance(pdf, str):
+            yield os.path.basename(pdf), pdf
+            continue
+
+        path = os.path.join(tmp_dir, f"{len(os.listdir(tmp_dir))}.pdf")
+        with open(path, "wb") as f:
+            f.write(pdf.getbuffer())
+        yield pdf.name, path
+
+
+def iter_pdf_pages(pdf_docs, max_workers=None, pages_per_task=PAGES_PER_TASK):
+    """ Yield (doc, page_no, text) for every page of every PDF, in order
+
+    Pages are extracted across a process pool. At most two tasks per worker
+    are in flight, so memory stays bounded however large the corpus is.
+    pdf_docs can be file paths or uploaded files.
+    """
+    workers = max_workers or os.cpu_count() or 1
+    in_flight = deque()
+
+    with tempfile.TemporaryDirectory() as tmp_dir, ProcessPoolExecutor(workers) as executor:
+        for name, path in _as_paths(pdf_docs, tmp_dir):
+            page_count = len(PdfReader(path).pages)
+            for start in range(0, page_count, pages_per_task):
+                end = min(start + pages_per_task, page_count)
+                in_flight.append(executor.submit(extract_page_range, path, name, start, end))
+
+                if len(in_flight) >= 2 * workers:
+                    yield from in_flight.popleft().result()
+
+        while in_flight:
+            yield from in_flight.popleft().result()
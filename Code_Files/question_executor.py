@@ -0,0 +1,334 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from model_client import FakeModel
+
+# Default number of questions in flight at once
+MAX_WORKERS = 4
+
+# Questions packed into one request in batch mode
+BATCH_SIZE = 10
+
+# Chunks retrieved per question in RAG mode
+TOP_K = 4
+
+
+def send(model, contents, history=None):
+    """ Send contents as one streamed request and return the answer text and its usage stats """
+    start = time.perf_counter()
+
+    if history:
+        # Dependent questions see the earlier answers as chat history
+        chat_session = model.start_chat(history=history)
+        response = chat_session.send_message(contents, stream=True)
+    else:
+        # A chat session is not safe to share between threads, so every independent
+        # question goes out as its own stateless generate_content call
+        response = model.generate_content(contents, stream=True)
+
+    # The answer is streamed, response.text is complete once every chunk is read
+    first_chunk_latency = None
+    for _ in response:
+        if first_chunk_latency is None:
+            first_chunk_latency = time.perf_counter() - start
+
+    usage = getattr(response, "usage_metadata", None)
+    stats = {
+        "latency": time.perf_counter() - start,
+        "first_chunk_latency": first_chunk_latency,
+        "prompt_tokens": getattr(usage, "prompt_token_count", 0),
+        "output_tokens": getattr(usage, "candidates_token_count", 0),
+    }
+    return response.text.strip(), stats
+
+
+def ask_question(model, gemini_files, question, history=None):
+    """ Send one question with the uploaded files and return the answer text and its usage stats """
+    return send(model, [*gemini_files, question], history)
+
+
+def context_prompt(passages):
+    """ The retrieved passages, sent in place of the documents """
+    return "\n\n".join([
+        "Answer from the following excerpts of the provided documents.",
+        *passages,
+    ])
+
+
+def ask_with_context(model, retrieve, question, history=None):
+    """ Send one question with only the passages retrieve(question) returns for it
+
+    Stats are those of ask_question plus "retrieval_latency" and "passages".
+    """
+    start = time.perf_counter()
+    passages = retrieve(question)
+    retrieval_latency = time.perf_counter() - start
+
+    response_text, stats = send(model, [context_prompt(passages), question], history)
+    stats.update({
+        "latency": stats["latency"] + retrieval_latency,
+        "retrieval_latency": retrieval_latency,
+        "passages": len(passages),
+    })
+    return response_text, stats
+
+
+def build_history(responses):
+    """ Turn answered questions into chat history for a dependent question """
+    history = []
+    for item in responses:
+        history.append({"role": "user", "parts": [item["question"]]})
+        history.append({"role": "model", "parts": [item["response"]]})
+    return history
+
+
+def answer_one(ask, item, label, history=None):
+    """ Ask a single question and build its response record """
+    question, tag = item["question"], item["tag"]
+    print(f"Sending question {label}: {question}")
+
+    response_text, stats = ask(question, history)
+    print(f"Response for {tag}: ", response_text)
+
+    return {"question": question, "tag": tag, "response": response_text, "stats": stats}
+
+
+def answer_dependent(ask, questions_with_tags, results):
+    """ Answer the "dependent" questions one at a time with every earlier answer as history """
+    total = len(questions_with_tags)
+    for i, item in enumerate(questions_with_tags):
+        if item.get("dependent"):
+            answered = [record for record in results if record is not None]
+            results[i] = answer_one(ask, item, f"{i + 1}/{total}", build_history(answered))
+    return results
+
+
+def run_questions(ask, questions_with_tags, max_workers=MAX_WORKERS):
+    """ Answer all questions and return responses in the original tag order
+
+    Independent questions are sent concurrently. Questions marked with
+    "dependent": True are sent afterwards, one at a time, with every earlier
+    answer passed in as history.
+    """
+    total = len(questions_with_tags)
+    results = [None] * total
+
+    def answer(i):
+        results[i] = answer_one(ask, questions_with_tags[i], f"{i + 1}/{total}")
+
+    independent = [i for i, item in enumerate(questions_with_tags) if not item.get("dependent")]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(answer, independent))
+
+    return answer_dependent(ask, questions_with_tags, results)
+
+
+def iter_questions(ask, questions_with_tags, max_workers=MAX_WORKERS):
+    """ Yield (index, response) pairs as soon as each answer arrives
+
+    Independent questions are sent concurrently and yielded in the order they
+    finish. Dependent questions follow one at a time, as in run_questions.
+    """
+    total = len(questions_with_tags)
+    results = [None] * total
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(answer_one, ask, item, f"{i + 1}/{total}"): i
+            for i, item in enumerate(questions_with_tags)
+            if not item.get("dependent")
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            yield i, results[i]
+
+    for i, item in enumerate(questions_with_tags):
+        if item.get("dependent"):
+            answered = [record for record in results if record is not None]
+            results[i] = answer_one(ask, item, f"{i + 1}/{total}", build_history(answered))
+            yield i, results[i]
+
+
+def batch_prompt(items):
+    """ One prompt asking for every tag's answer in a JSON object """
+    lines = [
+        "Answer each of the following questions from the provided documents.",
+        "Respond with a single JSON object. Use each tag exactly as written as a key and give the answer as a "
+        "markdown string value, with any tables as markdown tables.",
+        "",
+    ]
+    for item in items:
+        lines.append(f"{item['tag']}: {item['question']}")
+    return "\n".join(lines)
+
+
+def ask_batch(model, gemini_files, items):
+    """ Ask several questions in one JSON-mode request, returning ({tag: answer}, stats) """
+    start = time.perf_counter()
+    response = model.generate_content(
+        [*gemini_files, batch_prompt(items)],
+        generation_config={"response_mime_type": "application/json"}
+    )
+
+    usage = getattr(response, "usage_metadata", None)
+    stats = {
+        "latency": time.perf_counter() - start,
+        "prompt_tokens": getattr(usage, "prompt_token_count", 0),
+        "output_tokens": getattr(usage, "candidates_token_count", 0),
+    }
+
+    try:
+        answers = json.loads(response.text)
+    except ValueError:
+        print("Batch response was not valid JSON, falling back to single questions")
+        answers = {}
+    if not isinstance(answers, dict):
+        answers = {}
+
+    return answers, stats
+
+
+def run_questions_batched(model, gemini_files, ask, questions_with_tags, batch_size=BATCH_SIZE,
+                          max_workers=MAX_WORKERS):
+    """ Answer independent questions batch_size at a time in single JSON-mode requests
+
+    Tags missing from a batch answer, or answered with something other than
+    text, are retried one by one through ask(question, history). Dependent
+    questions are answered afterwards as in run_questions.
+
+    When ask is a cached_ask, tags with a cached answer are not batched, and
+    batched answers are cached under the same keys as single questions.
+    """
+    results = [None] * len(questions_with_tags)
+    independent = [i for i, item in enumerate(questions_with_tags) if not item.get("dependent")]
+    lookup, store = getattr(ask, "lookup", None), getattr(ask, "store", None)
+
+    if lookup is not None:
+        for i in independent:
+            item = questions_with_tags[i]
+            cached = lookup(item["question"])
+            if cached is not None:
+                results[i] = {"question": item["question"], "tag": item["tag"], "response": cached[0], "stats": cached[1]}
+
+    uncached = [i for i in independent if results[i] is None]
+    batches = [uncached[start:start + batch_size] for start in range(0, len(uncached), batch_size)]
+
+    def answer_batch(batch):
+        items = [questions_with_tags[i] for i in batch]
+        print(f"Sending {len(items)} questions in one request")
+        answers, stats = ask_batch(model, gemini_files, items)
+
+        # Tokens and latency are shared by every tag in the batch
+        share = {
+            "latency": stats["latency"],
+            "prompt_tokens": stats["prompt_tokens"] // len(items),
+            "output_tokens": stats["output_tokens"] // len(items),
+            "batched": True,
+        }
+        for i, item in zip(batch, items):
+            answer = answers.get(item["tag"])
+            if isinstance(answer, str):
+                results[i] = {"question": item["question"], "tag": item["tag"], "response": answer.strip(), "stats": share}
+                if store is not None:
+                    store(item["question"], answer.strip())
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(answer_batch, batches))
+
+    missing = [i for i in independent if results[i] is None]
+    if missing:
+        print(f"Falling back to single questions for {len(missing)} tags")
+        fallback = run_questions(ask, [questions_with_tags[i] for i in missing], max_workers)
+        for i, record in zip(missing, fallback):
+            results[i] = record
+
+    return answer_dependent(ask, questions_with_tags, results)
+
+
+def compare_modes(full_ask, rag_ask, questions_with_tags, max_workers=MAX_WORKERS):
+    """ Answer every question in both modes, returning (full responses, RAG responses) """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        full = executor.submit(run_questions, full_ask, questions_with_tags, max_workers)
+        rag = executor.submit(run_questions, rag_ask, questions_with_tags, max_workers)
+        return full.result(), rag.result()
+
+
+def mode_comparison(full_responses, rag_responses):
+    """ Per-tag prompt tokens and latency of full-document against RAG answers """
+    rows = []
+    for full, rag in zip(full_responses, rag_responses):
+        full_stats, rag_stats = full["stats"], rag["stats"]
+        rows.append({
+            "tag": full["tag"],
+            "full_prompt_tokens": full_stats["prompt_tokens"],
+            "rag_prompt_tokens": rag_stats["prompt_tokens"],
+            "full_latency": round(full_stats["latency"], 2),
+            "rag_latency": round(rag_stats["latency"], 2),
+            "passages": rag_stats.get("passages", 0),
+        })
+    return rows
+
+
+def print_mode_comparison(rows):
+    print(f"{'Tag':<30} {'Full tokens':>12} {'RAG tokens':>11} {'Full (s)':>9} {'RAG (s)':>8} {'Passages':>9}")
+    for row in rows:
+        print(f"{row['tag']:<30} {row['full_prompt_tokens']:>12} {row['rag_prompt_tokens']:>11} "
+              f"{row['full_latency']:>9.2f} {row['rag_latency']:>8.2f} {row['passages']:>9}")
+
+    full_total = sum(row["full_prompt_tokens"] for row in rows)
+    rag_total = sum(row["rag_prompt_tokens"] for row in rows)
+    print(f"{'Total':<30} {full_total:>12} {rag_total:>11}")
+
+
+def extraction_options(argv=None):
+    """ Read --batch, --rag, --top-k and --compare from the command line """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--batch", action="store_true", help="Answer the tags in batched JSON requests")
+    parser.add_argument("--rag", action="store_true",
+                        help="Send each question with its most relevant chunks instead of the whole documents")
+    parser.add_argument("--top-k", type=int, default=TOP_K, help="Chunks retrieved per question in RAG mode")
+    parser.add_argument("--compare", action="store_true",
+                        help="Also answer every tag in both modes, uncached, and report tokens and latency side by side")
+    options, _ = parser.parse_known_args(argv)
+    return options
+
+
+def print_usage_report(responses):
+    """ Print per-question latency and token counts """
+    print(f"{'Tag':<30} {'Latency (s)':>12} {'Prompt tokens':>14} {'Output tokens':>14}")
+    for item in responses:
+        stats = item["stats"]
+        print(f"{item['tag']:<30} {stats['latency']:>12.2f} {stats['prompt_tokens']:>14} {stats['output_tokens']:>14}")
+
+    prompt_total = sum(item["stats"]["prompt_tokens"] for item in responses)
+    output_total = sum(item["stats"]["output_tokens"] for item in responses)
+    print(f"{'Total':<30} {'':>12} {prompt_total:>14} {output_total:>14}")
+
+
+if __name__ == "__main__":
+    # Quick check of the speed-up against the fake model
+    questions = [{"question": f"Question {i}", "tag": f"<<Tag {i}>>"} for i in range(9)]
+    questions[-1]["dependent"] = True
+    fake_model = FakeModel(latency=0.5)
+    ask = partial(ask_question, fake_model, [])
+
+    for mode, run in [("concurrent", lambda: run_questions(ask, questions)),
+                      ("batched", lambda: run_questions_batched(fake_model, [], ask, questions)),
+                      ("streamed", lambda: [record for _, record in sorted(iter_questions(ask, questions),
+                                                                          key=lambda pair: pair[0])])]:
+        start = time.perf_counter()
+        results = run()
+        elapsed = time.perf_counter() - start
+
+        assert [r["tag"] for r in results] == [q["tag"] for q in questions]
+        print_usage_report(results)
+        print(f"{mode}: {len(questions)} questions answered in {elapsed:.2f}s")
+
+    # Whole documents against a few retrieved passages per question
+    document = ["RFP page text " * 2000]
+    rag_ask = partial(ask_with_context, fake_model, lambda question: [f"Passage on {question} " * 50] * TOP_K)
+    print_mode_comparison(mode_comparison(*compare_modes(partial(ask_question, fake_model, document), rag_ask, questions)))
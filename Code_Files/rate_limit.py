@@ -0,0 +1,365 @@
+import os
+import random
+import threading
+import time
+from google.api_core import exceptions as api_exceptions
+from googleapiclient.errors import HttpError
+from langchain_google_genai._common import GoogleGenerativeAIError
+
+# Quotas shared by every caller in the process, per Gemini endpoint group
+MODEL_RPM = int(os.getenv("MODEL_RPM", "60"))
+MODEL_TPM = int(os.getenv("MODEL_TPM", "1000000"))
+FILES_RPM = int(os.getenv("FILES_RPM", "120"))
+EMBED_RPM = int(os.getenv("EMBED_RPM", "1500"))
+EMBED_TPM = int(os.getenv("EMBED_TPM", "1000000"))
+
+# Requests in flight adapt between 1 and this
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "8"))
+
+# Retries of throttled or failed requests, with full-jitter exponential backoff
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+# A request this many times slower than the recent average of its kind counts as
+# overload, once that average has this many samples. The average is an EWMA,
+# so it follows the latency as the load or the documents change.
+LATENCY_FACTOR = 3.0
+LATENCY_WARMUP = 5
+LATENCY_EWMA = 0.2
+
+# Prompt files are settled against the real token count once the response arrives.
+# Text files count as their size at this many bytes a token. PDFs are billed about
+# 258 tokens a page and other media per item, neither known from the handle, so
+# they reserve about ten pages' worth.
+FILE_BYTES_PER_TOKEN = 4
+PDF_PAGE_TOKENS = 258
+FILE_RESERVED_TOKENS = 10 * PDF_PAGE_TOKENS
+
+# Errors worth retrying: quota (429), server errors and timeouts
+RETRYABLE = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.TooManyRequests,
+    api_exceptions.InternalServerError,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+)
+THROTTLED = (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests)
+
+# The same for file uploads, which go through googleapiclient and raise HttpError
+RETRYABLE_STATUS = (429, 500, 503)
+THROTTLED_STATUS = (429,)
+
+# Throttles shared by name across the process
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+
+def error_kind(error):
+    """ "throttled", "retryable" or None for an error from any of the Google clients """
+    # The LangChain embedder wraps whatever the API raised
+    if isinstance(error, GoogleGenerativeAIError) and error.__cause__ is not None:
+        error = error.__cause__
+    if isinstance(error, HttpError):
+        status = int(error.resp.status)
+        if status in THROTTLED_STATUS:
+            return "throttled"
+        return "retryable" if status in RETRYABLE_STATUS else None
+    if isinstance(error, THROTTLED):
+        return "throttled"
+    return "retryable" if isinstance(error, RETRYABLE) else None
+
+
+def estimate_tokens(contents):
+    """ Rough prompt size: 4 characters a token for text and text files, a fixed reservation for other files """
+    if isinstance(contents, str):
+        return len(contents) // 4
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_tokens(part) for part in contents)
+    if (getattr(contents, "mime_type", "") or "").startswith("text/"):
+        return (getattr(contents, "size_bytes", 0) or 0) // FILE_BYTES_PER_TOKEN
+    return FILE_RESERVED_TOKENS
+
+
+class RateLimiter:
+    """ Token buckets of requests and tokens per minute, each allowing a burst of a tenth of the minute
+
+    Token counts are only estimates when a request is sent, settle() charges
+    the difference once the real count is known, and the bucket may go
+    into debt so the next requests wait for it.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute=None):
+        self.request_rate = requests_per_minute / 60
+        self.token_rate = tokens_per_minute / 60 if tokens_per_minute else None
+        self.request_capacity = max(1, requests_per_minute // 10)
+        self.token_capacity = max(1, tokens_per_minute // 10) if tokens_per_minute else 0
+        self.requests = self.request_capacity
+        self.tokens = self.token_capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        self.requests = min(self.request_capacity, self.requests + elapsed * self.request_rate)
+        if self.token_rate:
+            self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_rate)
+
+    def acquire(self, tokens=0):
+        """ Block until one request of about this many tokens may be sent """
+        # A request larger than the burst would never fit, it waits for a full bucket instead
+        tokens = min(tokens, self.token_capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                token_wait = (tokens - self.tokens) / self.token_rate if self.token_rate and self.tokens < tokens else 0
+                request_wait = (1 - self.requests) / self.request_rate if self.requests < 1 else 0
+                if not token_wait and not request_wait:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+            time.sleep(max(token_wait, request_wait))
+
+    def settle(self, estimated, actual):
+        """ Charge the difference between a request's estimated and actual tokens """
+        if self.token_rate:
+            with self.lock:
+                self.tokens -= actual - estimated
+
+
+class AdaptiveConcurrency:
+    """ AIMD limit on requests in flight
+
+    Each fast success raises the limit by 1/limit, about one more slot per
+    round of requests. A throttled request, or one much slower than the
+    recent average of its kind, halves it. Kinds keep their own averages:
+    an upload is not slow next to a status poll, nor a whole answer next to
+    a first streamed chunk. Only requests sent after the last decrease can
+    cause another, so one overloaded round halves the limit once.
+    """
+
+    def __init__(self, initial=2, maximum=MAX_CONCURRENCY):
+        self.limit = float(min(initial, maximum))
+        self.maximum = maximum
+        self.in_flight = 0
+        self.baselines = {}  # kind -> (EWMA latency, samples)
+        self.decreased_at = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _decrease(self, started):
+        if started >= self.decreased_at:
+            self.limit = max(1.0, self.limit / 2)
+            self.decreased_at = time.monotonic()
+
+    def succeeded(self, kind, latency, started):
+        with self.condition:
+            baseline, samples = self.baselines.get(kind, (latency, 0))
+            if samples >= LATENCY_WARMUP and latency > LATENCY_FACTOR * baseline:
+                # Slow requests sent before the last decrease neither cut nor grow the limit
+                self._decrease(started)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.baselines[kind] = (baseline + LATENCY_EWMA * (latency - baseline), samples + 1)
+            self.condition.notify_all()
+
+    def throttled(self, started):
+        with self.condition:
+            self._decrease(started)
+
+
+class Throttle:
+    """ Rate limit, adaptive concurrency and retries in front of one endpoint group """
+
+    def __init__(self, requests_per_minute, tokens_per_minute=None, max_concurrency=MAX_CONCURRENCY):
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(maximum=max_concurrency)
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0}
+        self.lock = threading.Lock()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def call(self, fn, *args, tokens=0, kind=None, on_result=None, **kwargs):
+        """ fn(*args, **kwargs) within the limits, retried with jittered backoff
+
+        tokens is the estimated size of the request and kind groups requests
+        of similar latency, fn's name by default. on_result(result, started,
+        latency), if given, takes over the request's concurrency slot and
+        must end it with finish(), for results such as streams that are
+        still in flight when fn returns.
+        """
+        kind = kind or getattr(fn, "__name__", "call")
+        for attempt in range(MAX_ATTEMPTS):
+            self.limiter.acquire(tokens)
+            self.concurrency.acquire()
+            started = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self.concurrency.release()
+                failure = error_kind(e)
+                if failure == "throttled":
+                    self._count("throttled")
+                    self.concurrency.throttled(started)
+                if failure is None or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                self._count("retries")
+                time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+                continue
+            except BaseException:
+                self.concurrency.release()
+                raise
+
+            self._count("requests")
+            latency = time.monotonic() - started
+            if on_result is None:
+                self.finish(kind, started, latency)
+            else:
+                on_result(result, started, latency)
+            return result
+
+    def finish(self, kind, started, latency, estimated=0, actual=None, throttled=False):
+        """ Free a request's slot and feed back its latency and, if known, its real token count """
+        self.concurrency.release()
+        if throttled:
+            self._count("throttled")
+            self.concurrency.throttled(started)
+        else:
+            self.concurrency.succeeded(kind, latency, started)
+        if actual is not None:
+            self.limiter.settle(estimated, actual)
+
+
+def shared_throttle(name="model"):
+    """ The process-wide throttle called "model", "files" or "embed", created on first use """
+    with _throttles_lock:
+        if name not in _throttles:
+            _throttles[name] = {
+                "model": lambda: Throttle(MODEL_RPM, MODEL_TPM),
+                "files": lambda: Throttle(FILES_RPM),
+                "embed": lambda: Throttle(EMBED_RPM, EMBED_TPM),
+            }[name]()
+        return _throttles[name]
+
+
+def throttled(fn, name="model"):
+    """ fn wrapped in the shared throttle, for file and other plain API calls """
+    def call(*args, **kwargs):
+        return shared_throttle(name).call(fn, *args, **kwargs)
+    return call
+
+
+def usage_tokens(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "prompt_token_count", 0) + getattr(usage, "candidates_token_count", 0)
+
+
+class _Settled:
+    """ A streamed response that holds its concurrency slot until it has been read
+
+    The latency fed back is the time to the first chunk, and the real token
+    count is settled once the last chunk is in. A stream dropped unread
+    still gives its slot back.
+    """
+
+    def __init__(self, response, throttle, estimated, started):
+        self._response = response
+        self._throttle = throttle
+        self._estimated = estimated
+        self._started = started
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _finish(self, latency, throttled=False):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        actual = None if throttled else (usage_tokens(self._response) or self._estimated)
+        self._throttle.finish("first_chunk", self._started, latency, self._estimated, actual, throttled)
+
+    def __iter__(self):
+        first_chunk_latency = None
+        try:
+            for chunk in self._response:
+                if first_chunk_latency is None:
+                    first_chunk_latency = time.monotonic() - self._started
+                yield chunk
+        except Exception as e:
+            if error_kind(e) == "throttled":
+                self._finish(time.monotonic() - self._started, throttled=True)
+            raise
+        finally:
+            self._finish(first_chunk_latency or time.monotonic() - self._started)
+
+    def __del__(self):
+        if not getattr(self, "_finished", True):
+            self._finish(time.monotonic() - self._started)
+
+
+def _generate(throttle, send, contents, stream=False, **kwargs):
+    """ send(contents) through the throttle, settling its usage now or once the stream is read """
+    estimated = estimate_tokens(contents)
+    streams = []
+
+    def on_result(response, started, latency):
+        if stream:
+            streams.append(_Settled(response, throttle, estimated, started))
+        else:
+            throttle.finish("generate", started, latency, estimated, usage_tokens(response) or estimated)
+
+    response = throttle.call(send, contents, stream=stream, tokens=estimated, on_result=on_result, **kwargs)
+    return streams[0] if stream else response
+
+
+class RateLimitedChat:
+    def __init__(self, chat, throttle):
+        self.chat = chat
+        self.throttle = throttle
+
+    def send_message(self, contents, stream=False, **kwargs):
+        return _generate(self.throttle, self.chat.send_message, contents, stream, **kwargs)
+
+
+class RateLimitedModel:
+    """ Wraps a GenerativeModel so every request goes through the shared model throttle """
+
+    def __init__(self, model, throttle=None):
+        self.model = model
+        self.throttle = throttle or shared_throttle("model")
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        return _generate(self.throttle, self.model.generate_content, contents, stream, **kwargs)
+
+    def start_chat(self, **kwargs):
+        return RateLimitedChat(self.model.start_chat(**kwargs), self.throttle)
+
+
+class RateLimitedEmbeddings:
+    """ Wraps a LangChain embedder so every request goes through the shared embedding throttle """
+
+    def __init__(self, embedder, throttle=None):
+        self.embedder = embedder
+        self.throttle = throttle or shared_throttle("embed")
+
+    def embed_documents(self, texts):
+        return self.throttle.call(self.embedder.embed_documents, texts, tokens=estimate_tokens(list(texts)))
+
+    def embed_query(self, text):
+        return self.throttle.call(self.embedder.embed_query, text, tokens=estimate_tokens(text))
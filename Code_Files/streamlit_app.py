@@ -1,73 +1,42 @@
 import streamlit as st
 import os
-import time
-import google.generativeai as genai
 from dotenv import load_dotenv
-import re
-from docx import Document as WordDoc
-from docx.oxml import OxmlElement
+from functools import partial
 from docx2pdf import convert
 import base64
+import time
+from answer_cache import with_answer_cache
+from doc_prep import prepare_documents, print_stage_report
+from markdown_parser import parse_blocks
+from model_client import get_client
+from rate_limit import RateLimitedModel, throttled
+from question_executor import ask_question, iter_questions, run_questions_batched, extraction_options, print_usage_report
+from template_filler import TemplateFiller
+from upload_cache import UploadCache, file_hash
 
 
 # Load environment variables
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY_2")
 
-# Configure Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
+# Gemini API client, or an offline fake with MODEL_CLIENT=fake
+client = get_client(GEMINI_API_KEY)
 
 # Upload file to Gemini
 def upload_to_gemini(path, mime_type="application/pdf"):
     try:
-        file = genai.upload_file(path, mime_type=mime_type)
+        file = throttled(client.upload, "files")(path, mime_type=mime_type)
         return file
     except Exception as e:
-        st.error(f"Error uploading file: {e}")
+        # Runs on a preparation worker, failures are shown once all files are done
+        print(f"Error uploading file {path}: {e}")
         return None
 
-# Wait for file processing
-def wait_for_files_active(files):
-    print("Waiting for file processing...")
-    for name in (file.name for file in files):
-        file = genai.get_file(name)
-        while file.state.name == "PROCESSING":
-            print(".", end="", flush=True)
-            time.sleep(10)
-            file = genai.get_file(name)
-        if file.state.name != "ACTIVE":
-            raise Exception(f"File {file.name} failed to process")
-    print("...all files ready\n")
-
-def convert_docx_to_pdf(docx_path):
-    """ Convert .docx to .pdf using docx2pdf """
-    pdf_path = docx_path.replace(".docx", ".pdf")
-    convert(docx_path, pdf_path)
-    return pdf_path
-
-def save_uploaded_file(uploaded_file):
-    """ Save uploaded file and convert .docx to .pdf if needed """
-    temp_path = os.path.join("Uploaded_Docs", uploaded_file.name)
-    os.makedirs("Uploaded_Docs", exist_ok=True)
-
-    with open(temp_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-
-    if uploaded_file.name.endswith(".docx"):
-        pdf_path = convert_docx_to_pdf(temp_path)
-        return pdf_path
-
-    return temp_path
-
-# def save_uploaded_file(uploaded_file):
-#     temp_path = os.path.join("Uploaded_Docs", uploaded_file.name)
-#     os.makedirs("Uploaded_Docs", exist_ok=True)
-#
-#     with open(temp_path, "wb") as f:
-#         f.write(uploaded_file.getbuffer())
-#
-#     return temp_path
-
+def show_response(item):
+    """ Render one answer in the page as soon as it arrives """
+    st.subheader(item["tag"].strip("<>"))
+    for block in parse_blocks(item["response"]):
+        st.markdown(block["text"])
 
 # Streamlit UI
 st.title("AI RFP Processing with Gemini")
@@ -78,13 +47,20 @@ uploaded_file = st.file_uploader("Upload your RFP document", type=["pdf", "docx"
 if uploaded_file:
     st.success(f"File uploaded: {uploaded_file.name}")
 
-    file_path = save_uploaded_file(uploaded_file)
+    # A file with the same content as an earlier run is not uploaded again
+    get_file = throttled(client.get_file, "files")
+    upload_cache = UploadCache(upload_to_gemini, get_file)
+    upload_cache.evict_expired()
 
-    gemini_file = upload_to_gemini(file_path)
+    start = time.perf_counter()
+    [prepared] = prepare_documents([uploaded_file], upload_cache, get_file)
+    print_stage_report([prepared], time.perf_counter() - start)
+    file_path, gemini_file = prepared["path"], prepared["remote"]
+    if gemini_file is None:
+        st.error(f"Error uploading file: {uploaded_file.name}")
 
     if gemini_file:
-        st.success("File uploaded and processing started...")
-        wait_for_files_active([gemini_file])
+        st.success("File uploaded and processed...")
 
         # Configure Gemini model
         generation_config = {
@@ -95,17 +71,18 @@ if uploaded_file:
             "response_mime_type": "text/plain",
         }
 
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash",
-            generation_config=generation_config,
-            system_instruction="""
+        model_name = "gemini-2.0-flash"
+        system_instruction = """
             You are an expert file search assistant. Provide concise and structured responses based solely on the provided content and the query's requirements. 
             Do not ignore related content to the query as the information is very critical. If asked to list out details about anything make sure to include all the data related to it.
             Avoid including example information, formulas, or unnecessary details in your answers. Make sure to include tabular information wherever detected.
             """
-        )
 
-        chat_session = model.start_chat(history=[])
+        model = RateLimitedModel(client.model(
+            model_name=model_name,
+            generation_config=generation_config,
+            system_instruction=system_instruction
+        ))
 
         # Questions with tags
         questions_with_tags = [
@@ -115,133 +92,36 @@ if uploaded_file:
             {"question": "What are all the works to be performed for the customer assets?", "tag": "<<Work to be performed>>"},
         ]
 
-        # Process questions
-        responses = []
-
-        for i, item in enumerate(questions_with_tags):
-            question, tag = item["question"], item["tag"]
-            print(f"Sending question {i + 1}/{len(questions_with_tags)}: {question}")
-
-            response = chat_session.send_message([gemini_file, question])
-            response_text = response.text.strip()
-            responses.append({"question": question, "tag": tag, "response": response_text})
-
-            print("Response: ", response_text)
-
-
-        # Extract tables and surrounding text
-        def extract_tables_and_text(text):
-            sections = re.split(r'<br\s*/?>', text)
-            extracted_tables, before_table, after_table = [], "", ""
-            table_found = False
-
-            for section in sections:
-                lines = section.strip().split("\n")
-                table_lines, inside_table = [], False
-
-                for line in lines:
-                    if "|" in line:
-                        table_lines.append(line)
-                        inside_table = True
-                    elif inside_table and line.strip():
-                        table_lines.append(line)
-                    elif inside_table and not line.strip():
-                        inside_table = False
-                    elif not table_found:
-                        before_table += line + "\n"
-                    else:
-                        after_table += line + "\n"
-
-                if table_lines:
-                    extracted_tables.append("\n".join(table_lines).strip())
-                    table_found = True
-
-            return before_table.strip(), extracted_tables, after_table.strip()
-
-
-        # Insert an element after a paragraph (helper function)
-        def insert_element_after(paragraph, element):
-            p = paragraph._p
-            p.addnext(element)
-
-
-        # Add table after a paragraph
-        def add_table_after_paragraph(paragraph, table_text):
-            lines = table_text.strip().split("\n")
-            if len(lines) < 2:
-                return
-
-            headers = [h.strip() for h in lines[0].split("|")[1:-1]]
-            rows = [
-                [col.strip() for col in line.split("|")[1:-1]]
-                for line in lines[2:]
-                if len(line.split("|")) - 2 == len(headers)
-            ]
-
-            if not rows:
-                return
-
-            # Create a temporary document to build the table
-            temp_doc = WordDoc()
-            table = temp_doc.add_table(rows=len(rows) + 1, cols=len(headers))
-            table.style = 'Table Grid'
-
-            # Fill headers
-            for i, header in enumerate(headers):
-                table.cell(0, i).text = header
-
-            # Fill rows
-            for row_idx, row in enumerate(rows):
-                for col_idx, cell_text in enumerate(row):
-                    table.cell(row_idx + 1, col_idx).text = cell_text
-
-            # Insert the table after the target paragraph
-            insert_element_after(paragraph, table._element)
-
-
-        # Add a new paragraph after a paragraph
-        def add_paragraph_after(paragraph, text):
-            new_paragraph = OxmlElement('w:p')
-            insert_element_after(paragraph, new_paragraph)
-            p = paragraph._parent.add_paragraph(text)
-            insert_element_after(paragraph, p._element)
-            return p
-
-
-        # Fill template with responses
-        def fill_template(template_path, output_path, response_data):
-            doc = WordDoc(template_path)
-
-            for item in response_data:
-                tag, response = item["tag"], item["response"].strip()
-                before_text, tables, after_text = extract_tables_and_text(response)
-
-                for para in doc.paragraphs:
-                    if tag in para.text:
-                        # Remove the tag from the paragraph
-                        para.text = para.text.replace(tag, "")
-
-                        # Add before_text to the same paragraph
-                        if before_text:
-                            para.add_run(before_text.strip())
-
-                        # Add tables after the paragraph
-                        for table_text in tables:
-                            add_table_after_paragraph(para, table_text)
-
-                        # Add after_text as a new paragraph
-                        if after_text:
-                            add_paragraph_after(para, after_text.strip())
-
-            doc.save(output_path)
-            print(f"Template filled and saved to {output_path}")
+        # Answers are cached per document content, question and model setup,
+        # run with --no-cache or --refresh-cache to bypass the cache
+        model_config = {
+            "client": client.kind,
+            "model_name": model_name,
+            "system_instruction": system_instruction,
+            "generation_config": generation_config,
+        }
+        ask = with_answer_cache(partial(ask_question, model, [gemini_file]), [file_hash(file_path)], model_config)
 
         # Paths
         template_path = "../Proposal_Documents/Emerson_Proposal_Template.docx"
         output_path = "../Proposal_Documents/streamlit_filled_template_4.docx"
 
+        # Answers are shown and filled into the template as soon as each one arrives
+        filler = TemplateFiller(template_path)
+        if extraction_options().batch:
+            answers = enumerate(run_questions_batched(model, [gemini_file], ask, questions_with_tags))
+        else:
+            answers = iter_questions(ask, questions_with_tags)
+
+        responses = [None] * len(questions_with_tags)
+        for i, item in answers:
+            responses[i] = item
+            filler.fill(item)
+            show_response(item)
+        print_usage_report(responses)
+
         # Process Template
-        fill_template(template_path, output_path, responses)
+        filler.save(output_path)
         st.success("Template filled successfully!")
 
         # Convert .docx to PDF
@@ -0,0 +1,227 @@
+import re
+from collections import defaultdict
+from xml.sax.saxutils import escape
+from docx import Document as WordDoc
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import nsdecls, qn
+from docx.shared import Emu
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
+from markdown_parser import parse_blocks
+
+# Template placeholders look like <<Tag Name>>
+PLACEHOLDER = re.compile(r"<<[^<>]+>>")
+
+
+# Insert an element after another element (paragraph or table)
+def insert_element_after(anchor, element):
+    anchor.addnext(element)
+    return element
+
+
+# Scratch document shared by every table, only used for style ids and page width
+_scratch_doc = None
+
+TABLE_XML = (
+    '<w:tbl %s>'
+    '<w:tblPr><w:tblStyle w:val="{style_id}"/><w:tblW w:type="auto" w:w="0"/>'
+    '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" '
+    'w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>'
+    '<w:tblGrid>{grid}</w:tblGrid>{rows}</w:tbl>'
+) % nsdecls("w")
+
+
+# Markdown alignment to Word paragraph justification
+JUSTIFICATION = {"left": "left", "right": "right", "center": "center"}
+
+
+def scratch_document():
+    global _scratch_doc
+    if _scratch_doc is None:
+        _scratch_doc = WordDoc()
+    return _scratch_doc
+
+
+def build_table_element(headers, rows, align=None, style="Table Grid"):
+    """ Build the w:tbl element for a whole table in one pass
+
+    Produces the same markup as add_table plus cell.text in python-docx, which
+    rebuilds the cell grid on every table.cell() call. align optionally gives
+    "left", "right", "center" or None per column.
+    """
+    scratch = scratch_document()
+    style_id = scratch.styles[style].style_id
+    col_width = Emu(scratch._block_width // len(headers)).twips
+
+    cell_open = f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{col_width}"/></w:tcPr>'
+    paragraph_open = [
+        f'<w:p><w:pPr><w:jc w:val="{JUSTIFICATION[column_align]}"/></w:pPr>' if column_align else "<w:p>"
+        for column_align in (align or [None] * len(headers))
+    ]
+
+    parts = []
+    for row in [headers, *rows]:
+        parts.append("<w:tr>")
+        for cell_text, p_open in zip(row, paragraph_open):
+            if cell_text:
+                # Line breaks inside a cell become w:br like run.text does
+                runs = "<w:br/>".join(f'<w:t xml:space="preserve">{escape(line)}</w:t>' for line in cell_text.split("\n"))
+                parts.append(f"{cell_open}{p_open}<w:r>{runs}</w:r></w:p></w:tc>")
+            else:
+                parts.append(f"{cell_open}{p_open}</w:p></w:tc>")
+        parts.append("</w:tr>")
+
+    grid = f'<w:gridCol w:w="{col_width}"/>' * len(headers)
+    return parse_xml(TABLE_XML.format(style_id=style_id, grid=grid, rows="".join(parts)))
+
+
+def table_element(block):
+    """ Word table for a parsed table block """
+    return build_table_element(block["header"], block["rows"], block["align"])
+
+
+# Add a new paragraph after an element (paragraph or table)
+def add_paragraph_after(anchor, text, parent):
+    paragraph = Paragraph(OxmlElement('w:p'), parent)
+    if text:
+        paragraph.add_run(text)
+    return insert_element_after(anchor, paragraph._p)
+
+
+def replace_in_paragraph(paragraph, tag, replacement):
+    """ Replace a tag in a paragraph, even when Word has split it across several runs
+
+    Returns whether the tag was found.
+    """
+    runs = [Run(r, paragraph) for r in paragraph._p.iter(qn("w:r"))]
+    texts = [run.text for run in runs]
+    full_text = "".join(texts)
+
+    start = full_text.find(tag)
+    found = start != -1
+    while start != -1:
+        end = start + len(tag)
+        position, replaced = 0, False
+
+        for i, text in enumerate(texts):
+            run_start, run_end = position, position + len(text)
+            position = run_end
+            if run_end <= start or run_start >= end:
+                continue
+
+            # The replacement goes into the first run holding part of the tag,
+            # the rest of the tag is cut out of the following runs
+            cut_from, cut_to = max(start, run_start) - run_start, min(end, run_end) - run_start
+            texts[i] = text[:cut_from] + ("" if replaced else replacement) + text[cut_to:]
+            runs[i].text = texts[i]
+            replaced = True
+
+        full_text = "".join(texts)
+        start = full_text.find(tag, start + len(replacement))
+    return found
+
+
+def paragraph_text(p):
+    """ Text of a paragraph element including runs nested in hyperlinks and content controls """
+    return "".join(r.text for r in p.iter(qn("w:r")))
+
+
+def _story_roots(doc):
+    """ Body plus every header and footer that has its own definition """
+    roots = [("body", doc.element.body, doc._body)]
+    for section in doc.sections:
+        for kind, part in (
+            ("header", section.header), ("header", section.first_page_header), ("header", section.even_page_header),
+            ("footer", section.footer), ("footer", section.first_page_footer), ("footer", section.even_page_footer),
+        ):
+            if not part.is_linked_to_previous:
+                roots.append((kind, part._element, part))
+    return roots
+
+
+def build_tag_index(doc):
+    """ Scan the document once and map every placeholder to the paragraphs that hold it
+
+    Returns {tag: [(kind, paragraph)]} where kind is "body" for paragraphs in
+    the main text (including content controls), "cell" for paragraphs inside
+    tables, and "header" or "footer".
+
+    A text box's paragraphs sit inside the paragraph that anchors it, twice
+    when Word keeps a fallback copy, and their runs are part of that
+    paragraph's text. Only the outermost paragraph is indexed, replacing its
+    tag covers every copy.
+    """
+    index = defaultdict(list)
+    seen, indexed = set(), set()
+
+    for kind, root, parent in _story_roots(doc):
+        # Linked sections can share one header part, index it only once
+        if id(root) in seen:
+            continue
+        seen.add(id(root))
+
+        for p in root.iter(qn("w:p")):
+            text = paragraph_text(p)
+            if "<<" not in text:
+                continue
+            if any(ancestor in indexed for ancestor in p.iterancestors(qn("w:p"))):
+                continue
+            indexed.add(p)
+
+            location = "cell" if next(p.iterancestors(qn("w:tc")), None) is not None else kind
+            for tag in set(PLACEHOLDER.findall(text)):
+                index[tag].append((location, Paragraph(p, parent)))
+
+    return index
+
+
+class TemplateFiller:
+    """ Fills a template one response at a time, so the document can be built while answers arrive """
+
+    def __init__(self, template_path):
+        self.doc = WordDoc(template_path)
+        self.tag_index = build_tag_index(self.doc)
+
+    def fill(self, item):
+        """ Put one {"tag", "response"} record into every place its tag appears """
+        tag, response = item["tag"], item["response"].strip()
+        locations = self.tag_index.get(tag, [])
+        if not locations:
+            return
+
+        blocks = parse_blocks(response)
+
+        for location, para in locations:
+            if location != "body":
+                # Table cells, headers and footers get the raw response in place of the tag
+                replace_in_paragraph(para, tag, response)
+                continue
+
+            # Remove the tag from the paragraph, content goes in only where a tag was
+            if not replace_in_paragraph(para, tag, ""):
+                continue
+
+            # Leading text goes into the same paragraph, every other block
+            # follows it in the order it appears in the response
+            anchor = para._p
+            for n, block in enumerate(blocks):
+                if block["type"] == "text" and n == 0:
+                    para.add_run(block["text"])
+                elif block["type"] == "text":
+                    anchor = add_paragraph_after(anchor, block["text"], para._parent)
+                else:
+                    anchor = insert_element_after(anchor, table_element(block))
+                    # Keep consecutive tables from merging into one
+                    anchor = add_paragraph_after(anchor, "", para._parent)
+
+    def save(self, output_path):
+        self.doc.save(output_path)
+        print(f"Template filled and saved to {output_path}")
+
+
+# Fill template with responses
+def fill_template(template_path, output_path, response_data):
+    filler = TemplateFiller(template_path)
+    for item in response_data:
+        filler.fill(item)
+    filler.save(output_path)
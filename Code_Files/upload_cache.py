@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+CACHE_PATH = ".upload_cache.json"
+
+# Gemini keeps uploaded files for 48 hours, stop reusing them a little earlier
+DEFAULT_TTL = 47 * 60 * 60
+
+# Remote file handles by content hash, kept for the life of the process so
+# Streamlit reruns don't even need to look the file up again
+_handles = {}
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """ SHA-256 of a file's bytes, read in chunks """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _expiry_of(remote_file, ttl):
+    expiration_time = getattr(remote_file, "expiration_time", None)
+    if expiration_time is not None and hasattr(expiration_time, "timestamp"):
+        return expiration_time.timestamp()
+    return time.time() + ttl
+
+
+class UploadCache:
+    """ Maps file content hashes to already uploaded remote files
+
+    upload_fn(path, mime_type) and get_fn(name) are the upload backend,
+    normally upload_to_gemini and client.get_file.
+    """
+
+    def __init__(self, upload_fn, get_fn, path=CACHE_PATH, ttl=DEFAULT_TTL):
+        self.upload_fn = upload_fn
+        self.get_fn = get_fn
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        with open(self.path, "w") as f:
+            json.dump(self.entries, f, indent=2)
+
+    def evict(self, digest):
+        """ Forget a cached upload """
+        with self.lock:
+            self.entries.pop(digest, None)
+            _handles.pop(digest, None)
+            self._save()
+
+    def evict_expired(self):
+        """ Drop every entry past its expiry """
+        now = time.time()
+        with self.lock:
+            for digest in [d for d, entry in self.entries.items() if entry["expires_at"] <= now]:
+                self.entries.pop(digest)
+                _handles.pop(digest, None)
+            self._save()
+
+    def _lookup(self, digest):
+        entry = self.entries.get(digest)
+        if entry is None:
+            return None
+
+        if entry["expires_at"] <= time.time():
+            self.evict(digest)
+            return None
+
+        if digest in _handles:
+            return _handles[digest]
+
+        # Restore the handle by name from an earlier process
+        try:
+            remote_file = self.get_fn(entry["name"])
+        except Exception as e:
+            print(f"Cached upload {entry['name']} is no longer available: {e}")
+            remote_file = None
+
+        if remote_file is None or getattr(getattr(remote_file, "state", None), "name", "ACTIVE") == "FAILED":
+            self.evict(digest)
+            return None
+
+        _handles[digest] = remote_file
+        return remote_file
+
+    def get_or_upload(self, path, mime_type="application/pdf"):
+        """ Return (remote_file, ready) for a local file, uploading only if its content is new
+
+        ready is True when the file was already seen active, so waiting on
+        processing can be skipped.
+        """
+        digest = file_hash(path)
+
+        remote_file = self._lookup(digest)
+        if remote_file is not None:
+            print(f"Reusing uploaded file for {path}")
+            return remote_file, self.entries[digest]["active"]
+
+        remote_file = self.upload_fn(path, mime_type=mime_type)
+        if remote_file is None:
+            return None, False
+
+        with self.lock:
+            self.entries[digest] = {
+                "name": remote_file.name,
+                "path": path,
+                "expires_at": _expiry_of(remote_file, self.ttl),
+                "active": False,
+            }
+            _handles[digest] = remote_file
+            self._save()
+
+        return remote_file, False
+
+    def mark_active(self, remote_files):
+        """ Record that these uploads finished processing """
+        names = {remote_file.name for remote_file in remote_files}
+        with self.lock:
+            for entry in self.entries.values():
+                if entry["name"] in names:
+                    entry["active"] = True
+            self._save()
@@ -1,38 +1,308 @@
 import streamlit as st
-from PyPDF2 import PdfReader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import os
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-import google.generativeai as genai
+import hashlib
+import json
+import pickle
+import shutil
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, groupby
 from langchain.vectorstores import FAISS
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.chains.question_answering import load_qa_chain
 from langchain.prompts import PromptTemplate
+import faiss
+import numpy as np
 from dotenv import load_dotenv
+from ann_index import INDEX_TYPES, NPROBE, EF_SEARCH, build_index, set_search_params, all_vectors
+from bm25_index import BM25Index, reciprocal_rank_fusion
+from embedding_store import CachedEmbeddings
+from model_client import get_client
+from docx_extract import EXTRACT_VERSION, iter_docx_records
+from pdf_extract import iter_pdf_pages
+from rate_limit import RateLimitedEmbeddings, shared_throttle
+from upload_cache import file_hash
 
 load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+# Gemini API client, or an offline fake with MODEL_CLIENT=fake
+client = get_client(os.getenv("GEMINI_API_KEY"))
+
+INDEX_PATH = "faiss_index"
+MANIFEST_FILE = "manifest.json"
+
+CHUNK_SIZE = 10000
+CHUNK_OVERLAP = 1000
+
+# Pages are split once this many chunks' worth of text is buffered
+SPLIT_BUFFER_CHUNKS = 4
+
+# Chunks with their pages, per document content hash, extractor and splitter settings
+CHUNK_CACHE_PATH = "chunk_cache"
+
+# Chunks sent per embedding request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+
+# Index searched by queries, one of ann_index.INDEX_TYPES. The exact flat index is
+# always kept as well: it takes the incremental updates, and any other type is
+# rebuilt from its vectors after each change and saved next to it.
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+INDEX_NPROBE = int(os.getenv("INDEX_NPROBE", str(NPROBE)))
+INDEX_EF_SEARCH = int(os.getenv("INDEX_EF_SEARCH", str(EF_SEARCH)))
+
+# "hybrid" fuses BM25 and vector rankings, "vector" is similarity search alone
+RETRIEVAL = os.getenv("RETRIEVAL", "hybrid")
+
+# Candidates taken from each ranking, per chunk returned, before fusing
+HYBRID_FETCH_FACTOR = 3
 
 
 def get_pdf_text(pdf_docs):
-    text = ""
-    for pdf in pdf_docs:
-        pdf_reader = PdfReader(pdf)
-        for page in pdf_reader.pages:
-            text += page.extract_text()
-    return text
+    return "".join(text for _, _, text in iter_pdf_pages(pdf_docs))
 
 
 def get_text_chunks(text):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=10000, chunk_overlap=1000)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
     chunks = text_splitter.split_text(text)
     return chunks
 
 
+def iter_page_chunks(pages):
+    """ Split one document's (doc, page_no, text) records into (chunk, first_page, last_page)
+
+    The pages are never joined into one string: they are buffered until
+    there are a few chunks' worth, split, and the text of the last chunk,
+    which may be unfinished, is carried over into the next round. Each
+    chunk is located in the buffer to find the pages it spans.
+    """
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    buffer, size = [], 0  # [(page_no, text)]
+
+    def split(final):
+        joined = "".join(text for _, text in buffer)
+        starts = list(accumulate((len(text) for _, text in buffer), initial=0))
+        chunks = text_splitter.split_text(joined)
+
+        located, position = [], 0
+        for chunk in chunks:
+            start = joined.find(chunk, position)
+            start = position if start < 0 else start
+            end = max(start, start + len(chunk) - 1)
+            first = buffer[bisect_right(starts, start) - 1][0]
+            last = buffer[min(bisect_right(starts, end) - 1, len(buffer) - 1)][0]
+            located.append((chunk, first, last, start))
+            position = start + 1
+
+        if final or not located:
+            return [item[:3] for item in located], []
+
+        # Carry the raw text from the start of the last chunk, with its
+        # surrounding whitespace, so the next split sees the same separators
+        tail_start = located[-1][3]
+        carry = [
+            (page_no, joined[max(page_start, tail_start):page_end])
+            for (page_no, _), page_start, page_end in zip(buffer, starts, starts[1:])
+            if page_end > tail_start
+        ]
+        return [item[:3] for item in located[:-1]], carry
+
+    for _, page_no, text in pages:
+        buffer.append((page_no, text))
+        size += len(text)
+        if size < SPLIT_BUFFER_CHUNKS * CHUNK_SIZE:
+            continue
+
+        chunks, buffer = split(final=False)
+        size = sum(len(text) for _, text in buffer)
+        yield from chunks
+
+    if buffer:
+        chunks, _ = split(final=True)
+        yield from chunks
+
+
+def chunk_cache_key(doc_hash, extractor):
+    """ Chunk cache entry for document bytes read by extractor and split with the current settings """
+    settings = json.dumps({
+        "document": doc_hash,
+        "extractor": f"{extractor.__module__}.{extractor.__name__}",
+        "extractor_version": EXTRACT_VERSION if extractor is iter_docx_records else 1,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "split_buffer_chunks": SPLIT_BUFFER_CHUNKS,
+    }, sort_keys=True)
+    return hashlib.sha256(settings.encode("utf-8")).hexdigest()
+
+
+def load_cached_chunks(key):
+    """ Chunks and their pages from an earlier ingest of the same document bytes and settings """
+    path = os.path.join(CHUNK_CACHE_PATH, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_cached_chunks(key, chunks):
+    os.makedirs(CHUNK_CACHE_PATH, exist_ok=True)
+    with open(os.path.join(CHUNK_CACHE_PATH, f"{key}.json"), "w") as f:
+        json.dump(chunks, f)
+
+
 def get_vector_store(text_chunks):
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+    embeddings = cached(get_embeddings)
     vector_store = FAISS.from_texts(text_chunks, embedding=embeddings)
-    vector_store.save_local("faiss_index")
+    vector_store.save_local(INDEX_PATH)
+
+
+def chunk_id(doc_name, chunk):
+    """ Stable id for a chunk of a document, unchanged chunks keep their id across re-ingests """
+    return hashlib.sha256(f"{doc_name}\0{chunk}".encode("utf-8")).hexdigest()
+
+
+def load_manifest(index_path=INDEX_PATH):
+    """ {document name: {"hash": content hash, "chunks": [chunk ids]}} for the saved index """
+    path = os.path.join(index_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, index_path=INDEX_PATH):
+    with open(os.path.join(index_path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def update_vector_store(pdf_docs, index_path=INDEX_PATH):
+    """ Bring the saved index in line with pdf_docs, embedding only new or changed chunks
+
+    Documents whose bytes are unchanged are not even re-read, and documents
+    no longer in pdf_docs have their vectors removed. The BM25 index next
+    to it is kept in step. pdf_docs can be file paths or uploaded files,
+    of PDF or .docx documents.
+    """
+    embeddings = cached(get_embeddings)
+    manifest = load_manifest(index_path)
+    # The index is only ever written by this module, so its pickled docstore is trusted
+    vector_store = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True) if manifest else None
+
+    bm25 = BM25Index.load(index_path) if manifest else None
+    if bm25 is None:
+        # Indexes saved before there was a BM25 index get one from their docstore
+        bm25 = BM25Index()
+        if vector_store is not None:
+            bm25.add((cid, vector_store.docstore.search(cid).page_content)
+                     for cid in vector_store.index_to_docstore_id.values())
+
+    new_manifest, changed = {}, {}
+    texts, metadatas, ids = [], [], []
+    for pdf in pdf_docs:
+        if isinstance(pdf, str):
+            name, doc_hash = os.path.basename(pdf), file_hash(pdf)
+        else:
+            name, doc_hash = pdf.name, hashlib.sha256(pdf.getvalue()).hexdigest()
+        entry = manifest.get(name)
+        if entry and entry["hash"] == doc_hash:
+            new_manifest[name] = entry
+        else:
+            changed[name] = (pdf, doc_hash)
+
+    def add_chunks(name, chunks):
+        entry = manifest.get(name)
+        known = set(entry["chunks"]) if entry else set()
+        chunk_ids, seen = [], set()
+
+        for chunk, first_page, last_page in chunks:
+            cid = chunk_id(name, chunk)
+            if cid in seen:
+                continue
+            seen.add(cid)
+            chunk_ids.append(cid)
+            if cid not in known:
+                texts.append(chunk)
+                metadatas.append({"source": name, "page": first_page, "last_page": last_page})
+                ids.append(cid)
+        new_manifest[name] = {"hash": changed[name][1], "chunks": chunk_ids}
+
+    # Documents chunked before, under any name, are not read again.
+    # Word documents are read straight from their XML, never converted.
+    to_extract = []
+    for name, (pdf, doc_hash) in changed.items():
+        is_docx = name.endswith(".docx")
+        key = chunk_cache_key(doc_hash, iter_docx_records if is_docx else iter_pdf_pages)
+        chunks = load_cached_chunks(key)
+        if chunks is None and is_docx:
+            chunks = list(iter_page_chunks(iter_docx_records(pdf, name)))
+            save_cached_chunks(key, chunks)
+        if chunks is None:
+            to_extract.append(pdf)
+        else:
+            add_chunks(name, chunks)
+
+    # Pages of the other documents stream out of the extractor in order,
+    # so grouping by document name gives each document's pages in turn
+    for name, records in groupby(iter_pdf_pages(to_extract), key=lambda record: record[0]):
+        chunks = list(iter_page_chunks(records))
+        save_cached_chunks(chunk_cache_key(changed[name][1], iter_pdf_pages), chunks)
+        add_chunks(name, chunks)
+
+    kept = {cid for entry in new_manifest.values() for cid in entry["chunks"]}
+    stale = [cid for entry in manifest.values() for cid in entry["chunks"] if cid not in kept]
+
+    if vector_store is not None and stale:
+        vector_store.delete(stale)
+    bm25.remove(stale)
+    bm25.add(zip(ids, texts))
+
+    if texts and vector_store is None:
+        vector_store = FAISS.from_texts(texts, embedding=embeddings, metadatas=metadatas, ids=ids)
+    elif texts:
+        vector_store.add_texts(texts, metadatas=metadatas, ids=ids)
+
+    if not kept:
+        # Nothing left to search
+        shutil.rmtree(index_path, ignore_errors=True)
+    else:
+        vector_store.save_local(index_path)
+        bm25.save(index_path)
+        save_manifest(new_manifest, index_path)
+        if texts or stale or not os.path.exists(ann_index_file(index_path, INDEX_TYPE)):
+            save_ann_index(vector_store, index_path, INDEX_TYPE)
+
+    return {"added": len(texts), "removed": len(stale), "kept": len(kept) - len(texts)}
+
+
+def ann_index_file(index_path, index_type):
+    return os.path.join(index_path, f"{index_type}.faiss")
+
+
+def save_ann_index(vector_store, index_path=INDEX_PATH, index_type=INDEX_TYPE):
+    """ Train an index_type index on the flat index's vectors and save it beside it
+
+    Rows keep their order, so the flat index's docstore and row -> chunk id
+    mapping serve the new index too. Stale indexes of other types are removed.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {', '.join(INDEX_TYPES)}")
+
+    for other in INDEX_TYPES:
+        if other != index_type and os.path.exists(ann_index_file(index_path, other)):
+            os.remove(ann_index_file(index_path, other))
+    if index_type == "flat":
+        return
+
+    index, train_seconds = build_index(all_vectors(vector_store.index), index_type)
+    faiss.write_index(index, ann_index_file(index_path, index_type))
+    print(f"Built {index_type} index over {index.ntotal} vectors, trained in {train_seconds:.1f}s")
+
+
+def load_ann_store(index_path, embeddings, index_type):
+    """ A FAISS store over the saved index_type index, without loading the flat vectors """
+    index = faiss.read_index(ann_index_file(index_path, index_type))
+    set_search_params(index, INDEX_NPROBE, INDEX_EF_SEARCH)
+    with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
 
 
 def get_conversational_chain():
@@ -45,8 +315,7 @@ def get_conversational_chain():
     Answer:
     """
 
-    model = ChatGoogleGenerativeAI(model="gemini-2.0-flash",
-                                   temperature=0.3)
+    model = client.chat_model("gemini-2.0-flash", temperature=0.3)
 
     prompt = PromptTemplate(template=prompt_template, input_variables=["context", "question"])
     chain = load_qa_chain(model, chain_type="stuff", prompt=prompt)
@@ -54,20 +323,172 @@ def get_conversational_chain():
     return chain
 
 
-def user_input(user_question):
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+# Query resources are created once per process with st.cache_resource, which
+# survives Streamlit reruns, and shared by every session
+
+@st.cache_resource
+def resource_counters():
+    """ Lookups and cache misses for the resources below """
+    return {"lookups": 0, "misses": 0}
+
+
+def resource_stats():
+    counters = resource_counters()
+    return {"hits": counters["lookups"] - counters["misses"], "misses": counters["misses"]}
+
+
+def cached(resource, *args):
+    """ Fetch a cached resource, counting the lookup """
+    resource_counters()["lookups"] += 1
+    return resource(*args)
+
+
+# The bodies below only run on a cache miss
+
+@st.cache_resource
+def get_embeddings():
+    resource_counters()["misses"] += 1
+    # Batched, concurrent and backed by the on-disk embedding store, so unchanged
+    # chunks and repeated questions are never embedded twice. The batches that do go
+    # out share the embedding limiter, set with EMBED_RPM and EMBED_TPM
+    embedder = RateLimitedEmbeddings(client.embeddings())
+    return CachedEmbeddings(embedder, client.embedding_id, batch_size=EMBED_BATCH_SIZE)
+
+
+@st.cache_resource
+def get_qa_chain():
+    resource_counters()["misses"] += 1
+    return get_conversational_chain()
+
+
+@st.cache_resource(max_entries=2)
+def load_vector_store(index_path, mtime, index_type="flat"):
+    """ Loaded index, cached per modification time so a rebuilt index is picked up
+
+    Any index_type other than "flat" falls back to the flat index until it is built.
+    """
+    resource_counters()["misses"] += 1
+    if index_type != "flat" and os.path.exists(ann_index_file(index_path, index_type)):
+        return load_ann_store(index_path, cached(get_embeddings), index_type)
+    return FAISS.load_local(index_path, cached(get_embeddings), allow_dangerous_deserialization=True)
+
+
+@st.cache_resource(max_entries=1)
+def load_bm25_index(index_path, mtime):
+    resource_counters()["misses"] += 1
+    return BM25Index.load(index_path) or BM25Index()
+
+
+def index_mtime(index_path=INDEX_PATH):
+    return max(os.path.getmtime(os.path.join(index_path, name)) for name in os.listdir(index_path))
+
+
+@st.cache_resource(max_entries=1)
+def docstore_positions(index_path, mtime):
+    """ Chunk id -> row in the FAISS index, to pull one document's vectors directly """
+    resource_counters()["misses"] += 1
+    vector_store = cached(load_vector_store, index_path, mtime)
+    return {cid: position for position, cid in vector_store.index_to_docstore_id.items()}
+
+
+def search_in_documents(user_question, sources, k=4, index_path=INDEX_PATH):
+    """ Similarity search over the chunks of the given documents only
+
+    The documents' vectors are read straight out of the flat index by their
+    chunk ids, so the cost grows with those documents, not the whole corpus,
+    and the ranking is exact whatever INDEX_TYPE is.
+    """
+    mtime = index_mtime(index_path)
+    vector_store = cached(load_vector_store, index_path, mtime)
+    positions_by_id = cached(docstore_positions, index_path, mtime)
+
+    manifest = load_manifest(index_path)
+    positions = [
+        positions_by_id[cid]
+        for name in sources
+        for cid in manifest.get(name, {}).get("chunks", [])
+        if cid in positions_by_id
+    ]
+    if not positions:
+        return []
+
+    vectors = np.vstack([vector_store.index.reconstruct(position) for position in positions])
+    query = np.asarray(cached(get_embeddings).embed_query(user_question), dtype=np.float32)
+
+    # Squared L2 distance, the metric of the saved index
+    distances = ((vectors - query) ** 2).sum(axis=1)
+    best = np.argsort(distances)[:k]
+    return [vector_store.docstore.search(vector_store.index_to_docstore_id[positions[i]]) for i in best]
+
+
+def hybrid_search(question, k=4, index_path=INDEX_PATH):
+    """ The k chunks ranked best by BM25 and vector search together
+
+    Both searches run in parallel. Each returns HYBRID_FETCH_FACTOR * k
+    candidates, and the two rankings are combined with reciprocal rank
+    fusion. Exact terms such as a tender number are found by BM25 even
+    when their embedding is not close to the question's.
+    """
+    mtime = index_mtime(index_path)
+    vector_store = cached(load_vector_store, index_path, mtime, INDEX_TYPE)
+    bm25 = cached(load_bm25_index, index_path, mtime)
+    embeddings = cached(get_embeddings)
+    fetch_k = HYBRID_FETCH_FACTOR * k
+
+    def vector_ranking():
+        query = np.asarray([embeddings.embed_query(question)], dtype=np.float32)
+        _, rows = vector_store.index.search(query, fetch_k)
+        return [vector_store.index_to_docstore_id[row] for row in rows[0] if row >= 0]
+
+    def bm25_ranking():
+        return [cid for cid, _ in bm25.search(question, fetch_k)]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        rankings = [future.result() for future in [executor.submit(vector_ranking), executor.submit(bm25_ranking)]]
+
+    return [vector_store.docstore.search(cid) for cid in reciprocal_rank_fusion(rankings)[:k]]
+
+
+def retrieve(question, k=4, index_path=INDEX_PATH):
+    """ The k chunks for a question, by RETRIEVAL """
+    if RETRIEVAL == "hybrid":
+        return hybrid_search(question, k, index_path)
+    vector_store = cached(load_vector_store, index_path, index_mtime(index_path), INDEX_TYPE)
+    return vector_store.similarity_search(question, k=k)
+
+
+def retrieve_passages(question, k=4, index_path=INDEX_PATH):
+    """ The k chunks retrieved for the question, each headed by where it comes from """
+    docs = retrieve(question, k, index_path)
+    return [f"[{cite([doc])[0]}]\n{doc.page_content}" for doc in docs]
+
+
+def cite(docs):
+    """ "file.pdf p. 3-4" for each retrieved chunk """
+    citations = []
+    for doc in docs:
+        page, last_page = doc.metadata.get("page"), doc.metadata.get("last_page")
+        pages = f" p. {page}" if page == last_page else f" p. {page}-{last_page}"
+        citations.append(doc.metadata.get("source", "") + (pages if page else ""))
+    return list(dict.fromkeys(citations))
 
-    new_db = FAISS.load_local("faiss_index", embeddings)
-    docs = new_db.similarity_search(user_question)
 
-    chain = get_conversational_chain()
+def user_input(user_question, sources=None):
+    if sources:
+        docs = search_in_documents(user_question, sources)
+    else:
+        docs = retrieve(user_question)
+    chain = cached(get_qa_chain)
 
-    response = chain(
-        {"input_documents": docs, "question": user_question}
-        , return_only_outputs=True)
+    # The answer goes through the same model limiter as the proposal scripts
+    response = shared_throttle("model").call(
+        chain, {"input_documents": docs, "question": user_question}, return_only_outputs=True,
+        tokens=sum(len(doc.page_content) for doc in docs) // 4)
 
     print(response)
     st.write("Reply: ", response["output_text"])
+    if docs:
+        st.caption("Sources: " + "; ".join(cite(docs)))
 
 
 def main():
@@ -75,20 +496,23 @@ def main():
     st.header("Chat with PDF using Gemini💁")
 
     user_question = st.text_input("Ask a Question from the PDF Files")
+    sources = st.multiselect("Search only these documents", sorted(load_manifest()))
 
     if user_question:
-        user_input(user_question)
+        user_input(user_question, sources)
+        stats = resource_stats()
+        st.caption(f"Resource cache: {stats['hits']} hits, {stats['misses']} misses")
 
     with st.sidebar:
         st.title("Menu:")
         pdf_docs = st.file_uploader("Upload your PDF Files and Click on the Submit & Process Button",
-                                    accept_multiple_files=True)
+                                    type=["pdf", "docx"], accept_multiple_files=True)
         if st.button("Submit & Process"):
             with st.spinner("Processing..."):
-                raw_text = get_pdf_text(pdf_docs)
-                text_chunks = get_text_chunks(raw_text)
-                get_vector_store(text_chunks)
-                st.success("Done")
+                # Only new or changed chunks are embedded, removed documents drop out of the index
+                changes = update_vector_store(pdf_docs)
+                st.success(f"Done: {changes['added']} chunks added, {changes['removed']} removed, "
+                           f"{changes['kept']} unchanged")
 
 
 if __name__ == "__main__":